@@ -0,0 +1,365 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+"""micro-benchmarks for the performance-sensitive parts of GTM-SM.
+usage: python benchmark.py <name> [options], see python benchmark.py --help
+"""
+
+
+def _time(fn, repeats):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def _walk_states(options, steps):
+    '''states (steps, batch_size, 2) of the st recurrence along a random walk, as GTM_SM.forward infers them.
+    With --states random-walk, an unbounded gaussian random walk instead.'''
+    if options.states == 'random-walk':
+        return torch.randn(steps, options.batch_size, 2, generator=torch.Generator().manual_seed(0)).cumsum(0)
+    from predict import load_model
+    from roam import _walk
+
+    model = load_model(options.checkpoint)
+    _, action_selection = _walk(options.batch_size, model.s_dim, steps, np.random.RandomState(0))
+    actions = torch.from_numpy(np.eye(model.a_dim, dtype=np.float32)[action_selection]).transpose(0, 1)
+    with torch.no_grad():
+        replacement = model.enc_st_matrix(actions)
+        noise = torch.randn(replacement.shape, generator=torch.Generator().manual_seed(0)) * model.r_std
+        return model._st_scan(torch.zeros(options.batch_size, model.s_dim), replacement, noise)
+
+
+def benchmark_knn(options):
+    '''compare the spatial memory KNN backends on the states of a walk: the first observe_dim states are the
+    memory, the following ones the queries. grid-index queries a GridSpatialMemory built beforehand, as a
+    GTMSMSession does, the other backends get the whole memory on every query as in GTM_SM.forward'''
+    from spatial_memory import make_knn_backend, GridSpatialMemory
+
+    backends = {}
+    for name in options.backends:
+        try:
+            backends[name] = make_knn_backend(name) if name != 'grid-index' else None
+        except ImportError as error:
+            print('skipping {} backend: {}'.format(name, error))
+
+    states = _walk_states(options, max(options.observe_dims) + options.queries)
+    for observe_dim in options.observe_dims:
+        memory = states[:observe_dim]
+        queries = states[observe_dim:observe_dim + options.queries]
+        for name, backend in backends.items():
+            if backend is None:
+                grid = GridSpatialMemory(options.batch_size, capacity=observe_dim)
+                grid.extend(memory)
+                grid.query(queries, options.k)
+                seconds = _time(lambda: grid.query(queries, options.k), options.repeats)
+            else:
+                seconds = _time(lambda: backend.query(memory, queries, options.k), options.repeats)
+            print('observe_dim {:>6d}  {:>10s}  {:8.3f} ms/query'.format(observe_dim, name, seconds * 1e3))
+
+
+def benchmark_startup(options):
+    '''wall-clock time of a fresh interpreter importing each entry point'''
+    root = os.path.dirname(os.path.abspath(__file__))
+    for module in options.modules:
+        seconds = []
+        for _ in range(options.repeats):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, '-c', 'import ' + module], cwd=root)
+            seconds.append(time.perf_counter() - start)
+        print('import {:<10s}  median {:6.3f} s  min {:6.3f} s'.format(module, np.median(seconds), np.min(seconds)))
+
+
+def _ddp_worker(rank, world_size, options, results):
+    from torch.nn.parallel import DistributedDataParallel
+    from distributed import init_process_group, destroy_process_group, all_reduce_sum
+    from model import GTM_SM
+    from roam import TrajectoryPrefetcher
+
+    init_process_group(rank, world_size)
+    torch.manual_seed(rank)
+    model = GTM_SM(batch_size=options.batch_size)
+    walks = TrajectoryPrefetcher(model, 0, stream=2 * rank)
+    if world_size > 1:
+        model = DistributedDataParallel(model)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    images = torch.rand(options.batch_size, 3, 32, 32)
+
+    def step():
+        optimizer.zero_grad()
+        kld_loss, nll_loss = model(images, walks.get())[:2]
+        ((nll_loss + kld_loss) / len(images)).backward()
+        optimizer.step()
+
+    seconds = _time(lambda: [step() for _ in range(options.steps)], 1) / options.steps
+    # a synchronous step is as slow as the slowest rank
+    seconds = all_reduce_sum(seconds)[0] / world_size
+    walks.close()
+    destroy_process_group()
+    if rank == 0:
+        results.put(seconds)
+
+
+def benchmark_ddp(options):
+    '''training throughput of data-parallel cpu training, every rank training on batches of batch_size images'''
+    import torch.multiprocessing as mp
+    from distributed import launch
+
+    results = mp.get_context('spawn').SimpleQueue()
+    baseline = None
+    for world_size in options.world_sizes:
+        os.environ['MASTER_PORT'] = str(options.port + world_size)
+        launch(_ddp_worker, world_size, options, results)
+        seconds = results.get()
+        throughput = world_size * options.batch_size / seconds
+        baseline = baseline or throughput / world_size
+        print('ranks {:>2d}  {:8.3f} s/step  {:8.1f} images/s  speedup {:5.2f}'.format(
+            world_size, seconds, throughput, throughput / baseline))
+
+
+def _policy_worker(policy, options, results):
+    from model import GTM_SM
+    from roam import random_walk
+    from spatial_memory import make_knn_backend
+
+    policy.apply()
+    torch.manual_seed(0)
+    rng = np.random.RandomState(0)
+    knn = make_knn_backend(options.knn_backend, **({'policy': policy} if options.knn_backend == 'flann' else {}))
+    model = GTM_SM(batch_size=options.batch_size, knn_backend=knn)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    images = torch.rand(options.batch_size, 3, 32, 32)
+
+    def step():
+        optimizer.zero_grad()
+        kld_loss, nll_loss = model(images, random_walk(model, rng, policy=policy))[:2]
+        ((nll_loss + kld_loss) / len(images)).backward()
+        optimizer.step()
+
+    seconds = _time(step, options.repeats)
+    policy.close()
+    results.put(seconds)
+
+
+def benchmark_policy(options):
+    '''training step time of every execution policy, each measured in a fresh process since the inter-op
+    thread pool can only be sized once per process'''
+    import itertools
+    import multiprocessing
+    from execution import ExecutionPolicy
+
+    context = multiprocessing.get_context('spawn')
+    results = context.SimpleQueue()
+    timings = []
+    for intra_op_threads, inter_op_threads, cpu_workers in itertools.product(
+            options.intra_op_threads, options.inter_op_threads, options.cpu_workers):
+        policy = ExecutionPolicy(intra_op_threads, inter_op_threads, cpu_workers)
+        process = context.Process(target=_policy_worker, args=(policy, options, results))
+        process.start()
+        seconds = results.get()
+        process.join()
+        timings.append((seconds, policy))
+        print('intra-op {:>3d}  inter-op {:>3d}  workers {:>3d}  {:8.3f} s/step'.format(
+            intra_op_threads, inter_op_threads, cpu_workers, seconds))
+    seconds, policy = min(timings, key=lambda timing: timing[0])
+    print('best on {} cores: --intra-op-threads {} --inter-op-threads {} --cpu-workers {} ({:.3f} s/step)'.format(
+        os.cpu_count(), policy.intra_op_threads, policy.inter_op_threads, policy.cpu_workers, seconds))
+
+
+def benchmark_precision(options):
+    '''step time and losses of the reduced-precision modes against float32, on the saved checkpoint'''
+    from predict import load_model
+
+    model = load_model(options.checkpoint, batch_size=options.batch_size)
+    if options.images is None:
+        images = torch.rand(options.batch_size, 3, 32, 32, generator=torch.Generator().manual_seed(0))
+    else:
+        images = torch.from_numpy(np.array(np.load(options.images, mmap_mode='r')[:options.batch_size]))
+        images = images.float() / 255 if images.dtype == torch.uint8 else images.float()
+
+    def run(precision, training):
+        model.precision = precision
+        model.train(training)
+        # the same walk and the same random draws in every mode, so the losses only differ by precision
+        torch.manual_seed(0)
+        with torch.set_grad_enabled(training):
+            kld_loss, nll_loss = model(images, trajectory)[:2]
+        if training:
+            model.zero_grad()
+            ((nll_loss + kld_loss) / len(images)).backward()
+        return tuple(loss.item() if torch.is_tensor(loss) else float(loss) for loss in (kld_loss, nll_loss))
+
+    for training in (True, False):
+        if training:
+            from roam import random_walk
+            trajectory = random_walk(model, np.random.RandomState(0))
+        else:
+            model.total_dim, total_dim = model.eval_total_dim, model.total_dim
+            trajectory = random_walk(model, np.random.RandomState(0))
+            model.total_dim = total_dim
+        baseline = None
+        for precision in ['float32'] + options.precisions:
+            losses = run(precision, training)
+            seconds = _time(lambda: run(precision, training), options.repeats)
+            if baseline is None:
+                baseline = seconds, losses
+            print('{:<5s}  {:<8s}  {:8.3f} s/step  speedup {:5.2f}  kld {:12.4f} ({:+.2e})  nll {:12.4f} ({:+.2e})'.format(
+                'train' if training else 'eval', precision, seconds, baseline[0] / seconds,
+                losses[0], (losses[0] - baseline[1][0]) / max(abs(baseline[1][0]), 1e-12),
+                losses[1], (losses[1] - baseline[1][1]) / max(abs(baseline[1][1]), 1e-12)))
+
+
+def _walk_statistics(position, action_selection):
+    '''per-walk statistics (walks, statistics) and their names: the action histogram, the move rate and the
+    first and second moments of the positions over the walk and at its end'''
+    moved = (np.diff(position, axis=2) != 0).any(1)
+    position = position.astype(np.float64)
+    columns = [(action_selection == action).mean(1) for action in range(5)] + [moved.mean(1)]
+    names = ['action {}'.format(action) for action in range(5)] + ['move rate']
+    for axis, axis_name in enumerate('hw'):
+        columns += [position[:, axis].mean(1), (position[:, axis] ** 2).mean(1),
+                    position[:, axis, -1], position[:, axis, -1] ** 2]
+        names += [moment + ' ' + axis_name for moment in ('mean', 'second moment', 'final mean', 'final second moment')]
+    return np.stack(columns, 1), names
+
+
+def benchmark_kld(options):
+    '''time and bytes saved for backward by the Monte Carlo kld at several kl_samples. The saved tensors are
+    counted once per storage, so views of the same inputs are not counted twice.
+    Exits with status 1 if the saved bytes grow with kl_samples.'''
+    from model import GTM_SM
+
+    model = GTM_SM(kl_samples=options.kl_samples[0])
+    generator = torch.Generator().manual_seed(0)
+    shape = (options.steps, options.batch_size, model.k_nearest_neighbour, model.z_dim)
+    inputs = [torch.randn(shape[:2] + shape[3:], generator=generator),
+              torch.rand(shape[:2] + shape[3:], generator=generator) + 0.5,
+              torch.randn(shape, generator=generator),
+              torch.rand(shape, generator=generator) + 0.5,
+              torch.log_softmax(torch.randn(shape[:3], generator=generator), 2)]
+
+    saved_bytes = []
+    for kl_samples in options.kl_samples:
+        model.kl_samples = kl_samples
+        leaves = [value.clone().requires_grad_() for value in inputs]
+        storages = {}
+
+        def pack(tensor):
+            storage = tensor.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+            return tensor
+
+        start = time.perf_counter()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            log_p_theta = model._log_mixture_pdf_monte_carlo(*leaves)
+        log_p_theta.sum().backward()
+        seconds = time.perf_counter() - start
+        saved_bytes.append(sum(storages.values()))
+        print('kl_samples {:>6d}  {:8.3f} s  saved for backward {:8.2f} MB'.format(
+            kl_samples, seconds, saved_bytes[-1] / 2 ** 20))
+    if max(saved_bytes) > min(saved_bytes):
+        print('the saved bytes grow with kl_samples')
+        sys.exit(1)
+
+
+def benchmark_walk(options):
+    '''speed of the batched random walk against the original per-sample loop, and a two-sample z-test on
+    every statistic of _walk_statistics: the walks are independent, so the per-walk statistics are too.
+    Exits with status 1 if any |z| exceeds --max-z.'''
+    from roam import _walk, _walk_reference
+
+    walks = {}
+    for name, walk, seed in (('reference', _walk_reference, options.seed), ('batched', _walk, options.seed + 1)):
+        start = time.perf_counter()
+        position, action_selection = walk(options.walks, 2, options.total_dim, np.random.RandomState(seed))
+        seconds = time.perf_counter() - start
+        walks[name], names = _walk_statistics(position, action_selection)
+        print('{:<10s} {:8.3f} s for {} walks of {} steps'.format(name, seconds, options.walks, options.total_dim))
+
+    reference, batched = walks['reference'], walks['batched']
+    standard_error = np.sqrt((reference.var(0) + batched.var(0)) / options.walks)
+    z = (batched.mean(0) - reference.mean(0)) / np.maximum(standard_error, 1e-12)
+    for name, reference_mean, batched_mean, z_value in zip(names, reference.mean(0), batched.mean(0), z):
+        print('{:<26s} reference {:8.4f}  batched {:8.4f}  z {:+6.2f}{}'.format(
+            name, reference_mean, batched_mean, z_value, '' if abs(z_value) <= options.max_z else '  MISMATCH'))
+    if (np.abs(z) > options.max_z).any():
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GTM-SM benchmarks')
+    subparsers = parser.add_subparsers(dest='name')
+    subparsers.required = True
+
+    knn_parser = subparsers.add_parser('knn', help='spatial memory KNN backends')
+    knn_parser.add_argument('--backends', nargs='+', default=['torch', 'flann', 'grid', 'grid-index'])
+    knn_parser.add_argument('--observe-dims', nargs='+', type=int, default=[256, 1000, 10000, 100000])
+    knn_parser.add_argument('--states', default='model', choices=['model', 'random-walk'],
+                            help='states of the st recurrence of the saved model along a random walk, or an '
+                                 'unbounded gaussian random walk')
+    knn_parser.add_argument('--checkpoint', default='saves/gtm_sm_state_dict.pth')
+    knn_parser.add_argument('--batch-size', type=int, default=16)
+    knn_parser.add_argument('--queries', type=int, default=32)
+    knn_parser.add_argument('--k', type=int, default=5)
+    knn_parser.add_argument('--repeats', type=int, default=20)
+    knn_parser.set_defaults(run=benchmark_knn)
+
+    startup_parser = subparsers.add_parser('startup', help='process startup and import time of the entry points')
+    startup_parser.add_argument('--modules', nargs='+', default=['predict', 'sample', 'train', 'main'])
+    startup_parser.add_argument('--repeats', type=int, default=5)
+    startup_parser.set_defaults(run=benchmark_startup)
+
+    ddp_parser = subparsers.add_parser('ddp', help='scaling of the multi-process data-parallel training')
+    ddp_parser.add_argument('--world-sizes', nargs='+', type=int, default=[1, 2, 4, 8])
+    ddp_parser.add_argument('--batch-size', type=int, default=16, help='images per rank and step')
+    ddp_parser.add_argument('--steps', type=int, default=10)
+    ddp_parser.add_argument('--port', type=int, default=29500)
+    ddp_parser.set_defaults(run=benchmark_ddp)
+
+    cores = os.cpu_count() or 1
+    thread_counts = sorted({1, 2, 4, cores // 2, cores} - {0})
+    policy_parser = subparsers.add_parser('policy', help='torch thread pools and cpu worker processes')
+    policy_parser.add_argument('--intra-op-threads', nargs='+', type=int, default=thread_counts)
+    policy_parser.add_argument('--inter-op-threads', nargs='+', type=int, default=[1])
+    policy_parser.add_argument('--cpu-workers', nargs='+', type=int, default=[0] + thread_counts)
+    policy_parser.add_argument('--knn-backend', default='torch', choices=['torch', 'flann', 'grid'])
+    policy_parser.add_argument('--batch-size', type=int, default=16)
+    policy_parser.add_argument('--repeats', type=int, default=5)
+    policy_parser.set_defaults(run=benchmark_policy)
+
+    kld_parser = subparsers.add_parser('kld', help='memory saved for backward by the Monte Carlo kld')
+    kld_parser.add_argument('--kl-samples', nargs='+', type=int, default=[250, 1000, 4000])
+    kld_parser.add_argument('--steps', type=int, default=32)
+    kld_parser.add_argument('--batch-size', type=int, default=16)
+    kld_parser.set_defaults(run=benchmark_kld)
+
+    walk_parser = subparsers.add_parser('walk', help='batched random walks against the per-sample reference')
+    walk_parser.add_argument('--walks', type=int, default=2000)
+    walk_parser.add_argument('--total-dim', type=int, default=256)
+    walk_parser.add_argument('--seed', type=int, default=0)
+    walk_parser.add_argument('--max-z', type=float, default=5.0, help='largest accepted |z| of any statistic')
+    walk_parser.set_defaults(run=benchmark_walk)
+
+    precision_parser = subparsers.add_parser('precision', help='reduced-precision modes against float32')
+    precision_parser.add_argument('--precisions', nargs='+', default=['bfloat16'])
+    precision_parser.add_argument('--checkpoint', default='saves/gtm_sm_state_dict.pth')
+    precision_parser.add_argument('--images', default=None, help='.npy images (N, 3, 32, 32), random if not given')
+    precision_parser.add_argument('--batch-size', type=int, default=16)
+    precision_parser.add_argument('--repeats', type=int, default=5)
+    precision_parser.set_defaults(run=benchmark_precision)
+
+    options = parser.parse_args()
+    options.run(options)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import torch
+
+"""resumable training checkpoints. A checkpoint is a dict saved with torch.save, for main.py:
+
+    model, optimizer            state dicts
+    epoch, updating_counter     the last finished epoch and the position in the learning rate schedule
+    rng_states                  torch / cuda / numpy random states of every rank, see rng_state
+    train_walks, val_walks      indices of the next trajectory batch of the prefetchers
+    loader_train, loader_val    state of the shuffling of the loaders
+    history                     the loss arrays of result.npz
+
+CheckpointManager writes them atomically, rotates them and optionally saves them on a background thread.
+"""
+
+
+def rng_state():
+    '''the global torch, cuda and numpy random states of this process'''
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': np.random.get_state(),
+    }
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+
+
+def snapshot(obj):
+    '''a copy of obj with every tensor cloned to the cpu, safe to save while training goes on'''
+    if torch.is_tensor(obj):
+        return obj.detach().to(device='cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    if hasattr(obj, 'copy'):
+        return obj.copy()
+    return obj
+
+
+def atomic_save(obj, path):
+    '''torch.save to a temporary file in the same directory, then rename it over path,
+    so an interrupted save never leaves a truncated checkpoint behind'''
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+class CheckpointManager(object):
+    """Saves checkpoint_<epoch>.pth files in directory and keeps the keep_last most recent ones plus the
+    keep_best ones with the lowest metric, deleting the others. The list of checkpoints is kept in
+    directory/checkpoints.json, relative to directory, so the rotation carries on after a restart from any working
+    directory.
+    Arguments:
+        directory: where the checkpoints are written
+        keep_last: number of most recent checkpoints to keep
+        keep_best: number of checkpoints with the lowest metric (e.g. the validation loss) to keep
+        async_save: write on a background thread, save() only takes a cpu snapshot of the state
+    """
+
+    def __init__(self, directory='saves', keep_last=3, keep_best=1, async_save=True):
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.manifest_path = os.path.join(directory, 'checkpoints.json')
+        os.makedirs(directory, exist_ok=True)
+        self.checkpoints = []
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.checkpoints = json.load(f)
+        self.error = None
+        self.queue = None
+        if async_save:
+            self.queue = queue.Queue()
+            self.worker = threading.Thread(target=self._work, daemon=True)
+            self.worker.start()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is not None:
+                    self._write(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+            if item is None:
+                return
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('saving a checkpoint failed') from error
+
+    def save(self, state, epoch, metric=None):
+        '''save state as the checkpoint of epoch, metric ranks it for keep_best (lower is better)'''
+        self._check()
+        state = snapshot(state)
+        if self.queue is None:
+            self._write(state, epoch, metric)
+        else:
+            self.queue.put((state, epoch, metric))
+
+    def _path(self, entry):
+        return os.path.join(self.directory, entry['file'])
+
+    def _write(self, state, epoch, metric):
+        file = 'checkpoint_{}.pth'.format(epoch)
+        path = os.path.join(self.directory, file)
+        atomic_save(state, path)
+        self.checkpoints = [entry for entry in self.checkpoints if entry['file'] != file]
+        self.checkpoints.append({'epoch': epoch, 'file': file, 'metric': metric})
+
+        keep = sorted(self.checkpoints, key=lambda entry: entry['epoch'])[-self.keep_last:] if self.keep_last else []
+        ranked = [entry for entry in self.checkpoints if entry['metric'] is not None]
+        keep += sorted(ranked, key=lambda entry: entry['metric'])[:self.keep_best]
+        for entry in self.checkpoints:
+            if entry not in keep and os.path.exists(self._path(entry)):
+                os.remove(self._path(entry))
+        self.checkpoints = sorted((entry for entry in self.checkpoints if entry in keep),
+                                  key=lambda entry: entry['epoch'])
+
+        temporary_path = self.manifest_path + '.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(self.checkpoints, f, indent=1)
+        os.replace(temporary_path, self.manifest_path)
+        print('Saved checkpoint to ' + path)
+
+    def wait(self):
+        '''block until every queued checkpoint is written'''
+        if self.queue is not None:
+            self.queue.join()
+        self._check()
+
+    def close(self):
+        if self.queue is not None:
+            self.queue.put(None)
+            self.worker.join()
+            self.queue = None
+        self._check()
+
+    def latest(self):
+        '''path of the most recent checkpoint, None if there is none'''
+        self.wait()
+        return self._path(self.checkpoints[-1]) if self.checkpoints else None
+
+    def best(self):
+        '''path of the checkpoint with the lowest metric, None if there is none'''
+        self.wait()
+        ranked = [entry for entry in self.checkpoints if entry['metric'] is not None]
+        return self._path(min(ranked, key=lambda entry: entry['metric'])) if ranked else None
+
+
+def load_checkpoint(path, map_location='cpu'):
+    return torch.load(path, map_location=map_location, weights_only=False)
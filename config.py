@@ -1,28 +1,101 @@
 import torch
 import argparse
+from dataclasses import dataclass
 
-parser = argparse.ArgumentParser(description='GTM-SM Example')
-parser.add_argument('--batch-size', type=int, default=16, metavar='N',
-                    help='input batch size for training (default: 16)')
-parser.add_argument('--epochs', type=int, default=20000, metavar='N',
-                    help='number of epochs to train (default: 2000)')
-parser.add_argument('--no-cuda', action='store_true', default=False,
-                    help='enables CUDA training')
-parser.add_argument('--seed', type=int, default=1, metavar='S',
-                    help='random seed (default: 1)')
-parser.add_argument('--log-interval', type=int, default=50, metavar='N',
-                    help='how many batches to wait before logging training status (default: 10)')
-parser.add_argument('--save-interval', type=int, default=1, metavar='N',
-                    help='how many epochs to wait before saving model status (default: 1)')
-parser.add_argument('--gradient-clip', type=int, default=10, metavar='N',
-                    help='the maximum norm of the gradient will be used (default: 10)')
-args = parser.parse_args()
-args.cuda = not args.no_cuda and torch.cuda.is_available()
-
-torch.manual_seed(args.seed)
-if args.cuda:
-    torch.cuda.manual_seed_all(args.seed)
-
-device = torch.device("cuda" if args.cuda else "cpu")
-
-kwargs = {'num_workers': 1, 'pin_memory': True} if args.cuda else {}
\ No newline at end of file
+"""training configuration. Importing this module has no side effects: the command line is only parsed by
+parse_args and the random number generators are only seeded by seed_everything, both called by the entry points.
+"""
+
+
+@dataclass
+class Config:
+    batch_size: int = 16
+    epochs: int = 20000
+    no_cuda: bool = False
+    seed: int = 1
+    log_interval: int = 50
+    save_interval: int = 1
+    gradient_clip: int = 10
+    dataset_cache: str = './datasets/CelebA_32x32'
+    world_size: int = 1
+    dist_backend: str = 'gloo'
+    knn_backend: str = 'torch'
+    intra_op_threads: int = None
+    inter_op_threads: int = None
+    cpu_workers: int = 0
+    precision: str = 'float32'
+    checkpoint_dir: str = 'saves'
+    keep_last: int = 3
+    keep_best: int = 1
+    resume: str = None
+
+    @property
+    def cuda(self):
+        return not self.no_cuda and torch.cuda.is_available()
+
+    @property
+    def device(self):
+        return torch.device("cuda" if self.cuda else "cpu")
+
+    @property
+    def loader_kwargs(self):
+        return {'num_workers': 1, 'pin_memory': True} if self.cuda else {}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='GTM-SM Example')
+    parser.add_argument('--batch-size', type=int, default=16, metavar='N',
+                        help='input batch size for training (default: 16)')
+    parser.add_argument('--epochs', type=int, default=20000, metavar='N',
+                        help='number of epochs to train (default: 2000)')
+    parser.add_argument('--no-cuda', action='store_true', default=False,
+                        help='enables CUDA training')
+    parser.add_argument('--seed', type=int, default=1, metavar='S',
+                        help='random seed (default: 1)')
+    parser.add_argument('--log-interval', type=int, default=50, metavar='N',
+                        help='how many batches to wait before logging training status (default: 10)')
+    parser.add_argument('--save-interval', type=int, default=1, metavar='N',
+                        help='how many epochs to wait before saving model status (default: 1)')
+    parser.add_argument('--gradient-clip', type=int, default=10, metavar='N',
+                        help='the maximum norm of the gradient will be used (default: 10)')
+    parser.add_argument('--dataset-cache', default='./datasets/CelebA_32x32', metavar='DIR',
+                        help='directory of the splits converted by dataset.py, used instead of decoding the '
+                             'CelebA images when present (default: ./datasets/CelebA_32x32)')
+    parser.add_argument('--world-size', type=int, default=1, metavar='N',
+                        help='number of data-parallel training processes started on this machine, each training on '
+                             'its own shard with batches of --batch-size images (default: 1)')
+    parser.add_argument('--dist-backend', default='gloo', metavar='NAME',
+                        help='torch.distributed backend of the multi-process training (default: gloo)')
+    parser.add_argument('--knn-backend', default='torch', choices=['torch', 'flann', 'grid'],
+                        help='spatial memory KNN backend (default: torch)')
+    parser.add_argument('--intra-op-threads', type=int, default=None, metavar='N',
+                        help='torch intra-op threads per process (default: torch default, divided between the ranks)')
+    parser.add_argument('--inter-op-threads', type=int, default=None, metavar='N',
+                        help='torch inter-op threads per process (default: torch default)')
+    parser.add_argument('--cpu-workers', type=int, default=0, metavar='N',
+                        help='worker processes for the per-sample cpu stages, the pyflann KNN and the random walk '
+                             'generation, 0 runs them in the training process (default: 0)')
+    parser.add_argument('--precision', default='float32', choices=['float32', 'bfloat16'],
+                        help='bfloat16 runs the encoder, the decoder and the gaussian log pdf of the kld under '
+                             'reduced precision, the rest stays in float32 (default: float32)')
+    parser.add_argument('--checkpoint-dir', default='saves', metavar='DIR',
+                        help='directory of the training checkpoints (default: saves)')
+    parser.add_argument('--keep-last', type=int, default=3, metavar='N',
+                        help='number of most recent checkpoints to keep (default: 3)')
+    parser.add_argument('--keep-best', type=int, default=1, metavar='N',
+                        help='number of checkpoints with the lowest validation loss to keep (default: 1)')
+    parser.add_argument('--resume', nargs='?', const='latest', default=None, metavar='PATH',
+                        help='continue training from a checkpoint, the latest one in --checkpoint-dir if no path '
+                             'is given')
+    return parser
+
+
+def parse_args(argv=None):
+    '''parse argv (default: sys.argv[1:]) into a Config'''
+    return Config(**vars(build_parser().parse_args(argv)))
+
+
+def seed_everything(seed, cuda=False):
+    torch.manual_seed(seed)
+    if cuda:
+        torch.cuda.manual_seed_all(seed)
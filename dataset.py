@@ -0,0 +1,179 @@
+import argparse
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
+
+"""preprocessed CelebA store. convert() decodes and resizes every split of the ImageFolder dataset once and writes
+it to a contiguous uint8 array of shape (N, 3, 32, 32), `<split>.npy`, next to the class labels `<split>_labels.npy`:
+
+    python dataset.py --root ./datasets/CelebA --output ./datasets/CelebA_32x32
+
+MemmapImageDataset then maps a whole split with a single mmap instead of opening and decoding every JPEG per epoch,
+and TensorBatchLoader serves batches straight from it.
+"""
+
+SPLITS = ('training', 'val', 'testing')
+
+
+class MemmapImageDataset(Dataset):
+    """Zero-copy dataset over a converted split. Items are (image, label) like ImageFolder + ToTensor,
+    with the image a float tensor in [0, 1] of shape (3, 32, 32).
+    The array is mapped copy-on-write, so tensors share the pages of the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.images = np.load(path, mmap_mode='c')
+        labels_path = path[:-len('.npy')] + '_labels.npy'
+        if os.path.exists(labels_path):
+            self.labels = np.load(labels_path)
+        else:
+            self.labels = np.zeros(len(self.images), np.int64)
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        return torch.from_numpy(self.images[index]).float().div_(255), int(self.labels[index])
+
+
+class TensorBatchLoader(object):
+    """Batch iterator over a MemmapImageDataset held as one uint8 tensor, bypassing DataLoader's per-item
+    __getitem__ + collate. Every epoch shuffles the indices with a seeded permutation and yields
+    (images, labels) batches gathered with index_select, images as float in [0, 1].
+    Arguments:
+        dataset: MemmapImageDataset
+        batch_size: number of images per batch
+        shuffle: draw a new permutation every epoch
+        drop_last: drop the final partial batch, so every batch has exactly batch_size images
+        seed: seed of the permutations, the same on every rank so that the shards are disjoint
+        device: device the images are kept on, e.g. to keep a whole split resident on the GPU
+        rank, num_replicas: like DistributedSampler, iterate over the rank-th of num_replicas shards of every
+            permutation. The permutation is padded by wrapping around so that every rank runs the same number
+            of batches.
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False, seed=0, device=None, rank=0,
+                 num_replicas=1):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.rank = rank
+        self.num_replicas = num_replicas
+        # one sequential read of the whole split, the batches are then gathered from memory
+        self.images = torch.from_numpy(np.array(dataset.images)).to(device=device)
+        self.labels = torch.from_numpy(np.asarray(dataset.labels, np.int64)).to(device=device)
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    @property
+    def num_samples(self):
+        '''number of images served to this rank per epoch'''
+        return (len(self.images) + self.num_replicas - 1) // self.num_replicas
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def state_dict(self):
+        '''the state of the permutation generator, to resume the shuffling of an interrupted run'''
+        return {'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state_dict):
+        self.generator.set_state(state_dict['generator'])
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.images), generator=self.generator).to(device=self.images.device)
+        else:
+            order = torch.arange(len(self.images), device=self.images.device)
+        if self.num_replicas > 1:
+            padding = self.num_samples * self.num_replicas - len(order)
+            order = torch.cat([order, order[:padding]])[self.rank::self.num_replicas]
+        for batch in range(len(self)):
+            index = order[batch * self.batch_size:(batch + 1) * self.batch_size]
+            yield self.images.index_select(0, index).float().div_(255), self.labels.index_select(0, index)
+
+
+def make_loader(dataset, batch_size, shuffle=True, drop_last=False, seed=0, rank=0, num_replicas=1, **kwargs):
+    '''TensorBatchLoader for converted splits, DataLoader with kwargs otherwise.
+    With num_replicas > 1 every rank iterates over its own shard, through a DistributedSampler for a DataLoader.'''
+    if isinstance(dataset, MemmapImageDataset):
+        return TensorBatchLoader(dataset, batch_size, shuffle=shuffle, drop_last=drop_last, seed=seed, rank=rank,
+                                 num_replicas=num_replicas)
+    if num_replicas > 1:
+        sampler = DistributedSampler(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        return DataLoader(dataset, batch_size=batch_size, sampler=sampler, drop_last=drop_last, **kwargs)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last, **kwargs)
+
+
+def set_epoch(loader, epoch):
+    '''reshuffle a DistributedSampler for the epoch, TensorBatchLoader draws a new permutation by itself'''
+    if isinstance(getattr(loader, 'sampler', None), DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+def load_dataset(split, root='./datasets/CelebA', cache_dir='./datasets/CelebA_32x32'):
+    '''the converted split in cache_dir if it exists, otherwise the ImageFolder under root'''
+    path = os.path.join(cache_dir, split + '.npy')
+    if os.path.exists(path):
+        return MemmapImageDataset(path)
+
+    import torchvision.datasets as dset
+    import torchvision.transforms as T
+    data_transform = T.Compose([
+        T.Resize((32, 32)),
+        T.ToTensor(),
+    ])
+    return dset.ImageFolder(root=os.path.join(root, split), transform=data_transform)
+
+
+def convert(root='./datasets/CelebA', output='./datasets/CelebA_32x32', splits=SPLITS, image_size=32,
+            batch_size=256, num_workers=0):
+    '''decode and resize the ImageFolder splits under root into uint8 .npy arrays under output'''
+    import torchvision.datasets as dset
+    import torchvision.transforms as T
+
+    # the same resize as the ImageFolder pipeline, stopping before the conversion to float
+    data_transform = T.Compose([
+        T.Resize((image_size, image_size)),
+        T.PILToTensor(),
+    ])
+    os.makedirs(output, exist_ok=True)
+    for split in splits:
+        folder = dset.ImageFolder(root=os.path.join(root, split), transform=data_transform)
+        path = os.path.join(output, split + '.npy')
+        # write to a temporary file first so an interrupted conversion never looks complete
+        temporary_path = path + '.tmp.npy'
+        images = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.uint8,
+                                           shape=(len(folder), 3, image_size, image_size))
+        labels = np.zeros(len(folder), np.int64)
+        loader = DataLoader(folder, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        start = 0
+        for batch_images, batch_labels in loader:
+            images[start:start + len(batch_images)] = batch_images.numpy()
+            labels[start:start + len(batch_images)] = batch_labels.numpy()
+            start += len(batch_images)
+        images.flush()
+        del images
+        np.save(os.path.join(output, split + '_labels.npy'), labels)
+        os.replace(temporary_path, path)
+        print('Converted {} images of {} to {}'.format(len(folder), split, path))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert CelebA to 32x32 uint8 arrays')
+    parser.add_argument('--root', default='./datasets/CelebA', help='ImageFolder root with one folder per split')
+    parser.add_argument('--output', default='./datasets/CelebA_32x32', help='directory of the converted arrays')
+    parser.add_argument('--splits', nargs='+', default=list(SPLITS))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='decoding worker processes')
+    options = parser.parse_args(argv)
+    convert(options.root, options.output, options.splits, num_workers=options.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+"""helpers for data-parallel training with torch.distributed. Every helper also works without an initialised
+process group, in which case the single process is rank 0 of a world of size 1.
+"""
+
+
+def launch(fn, world_size, *args, master_addr='127.0.0.1', master_port=29500):
+    '''run fn(rank, world_size, *args) in world_size local processes, or in this process if world_size is 1.
+    Processes started by torchrun, which sets RANK and WORLD_SIZE, run fn directly with their own rank.'''
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        return fn(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), *args)
+    if world_size == 1:
+        return fn(0, 1, *args)
+    os.environ.setdefault('MASTER_ADDR', master_addr)
+    os.environ.setdefault('MASTER_PORT', str(master_port))
+    import torch.multiprocessing as mp
+    mp.spawn(fn, args=(world_size,) + args, nprocs=world_size, join=True)
+
+
+def init_process_group(rank, world_size, backend='gloo'):
+    '''join the process group of a multi-process run and split the cpu cores evenly between the ranks'''
+    if world_size == 1:
+        return
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    # every rank runs its own intra-op thread pool, oversubscribing the cores would slow all of them down
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+
+def destroy_process_group():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def all_reduce_sum(*values):
+    '''sum python numbers over all ranks, returns a list of floats'''
+    if not is_distributed():
+        return [float(value) for value in values]
+    total = torch.tensor([float(value) for value in values], dtype=torch.float64)
+    dist.all_reduce(total)
+    return total.tolist()
+
+
+def all_gather_object(obj):
+    '''the list of obj of every rank, [obj] without a process group'''
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
@@ -0,0 +1,70 @@
+import os
+import threading
+from dataclasses import dataclass
+
+import torch
+
+"""runtime execution policy of the cpu work: the sizes of the torch thread pools and a persistent process pool
+that the per-sample numpy stages (pyflann kd-trees, random walk generation) fan out to.
+"""
+
+
+def _init_worker():
+    # the workers only run numpy / pyflann code, one torch thread each keeps them from competing for the cores
+    torch.set_num_threads(1)
+
+
+@dataclass
+class ExecutionPolicy:
+    '''None keeps the torch default of a thread count, cpu_workers=0 runs the per-sample stages in process'''
+    intra_op_threads: int = None
+    inter_op_threads: int = None
+    cpu_workers: int = 0
+
+    def __post_init__(self):
+        self._pool = None
+        # the pool is shared by the prefetcher threads, only one of them may start it
+        self._pool_lock = threading.Lock()
+
+    def __getstate__(self):
+        # a copy sent to another process starts its own pool
+        return {'intra_op_threads': self.intra_op_threads, 'inter_op_threads': self.inter_op_threads,
+                'cpu_workers': self.cpu_workers}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__post_init__()
+
+    def apply(self):
+        '''set the torch thread pools of this process, the inter-op pool can only be sized before its first use'''
+        if self.intra_op_threads is not None:
+            torch.set_num_threads(self.intra_op_threads)
+        if self.inter_op_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError:
+                print('the inter-op thread pool is already running, keeping {} threads'.format(
+                    torch.get_num_interop_threads()))
+        return self
+
+    @property
+    def pool(self):
+        '''the persistent worker pool, a concurrent.futures executor started on first use, None without workers'''
+        if self.cpu_workers > 0:
+            with self._pool_lock:
+                if self._pool is None:
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor
+                    # spawn rather than fork, forking a process with running torch thread pools can deadlock
+                    self._pool = ProcessPoolExecutor(self.cpu_workers, initializer=_init_worker,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def describe(self):
+        return 'intra-op threads {}, inter-op threads {}, cpu workers {} ({} cores)'.format(
+            torch.get_num_threads(), torch.get_num_interop_threads(), self.cpu_workers, os.cpu_count())
@@ -0,0 +1,100 @@
+import argparse
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+
+from model import st_transition_scan, gather_neighbours, neighbour_weights, sample_mixture
+from spatial_memory import knn_query
+from utils.torch_utils import gather_patches
+
+"""export a trained GTM-SM to a single TorchScript artifact for deployment inference.
+The artifact is loaded with torch.jit.load and runs without this repository, the global config or pyflann:
+
+    model = torch.jit.load('saves/gtm_sm_inference.pt')
+    xt_prediction, st = model(x, action_one_hot_value, position)
+"""
+
+
+class GTM_SM_Inference(nn.Module):
+    """Scriptable prediction path of a trained GTM_SM.
+    Given the images and an explicit trajectory, it encodes the first observe_dim glimpses into the spatial
+    memory and predicts the glimpses of the remaining steps from their k nearest neighbours.
+    forward(x, action_one_hot_value, position)
+        x                       tensor  (batch_size, 3, 32, 32)
+        action_one_hot_value    tensor  (batch_size, a_dim, T - 1)
+        position                tensor  (batch_size, s_dim, T)     long, only the first observe_dim steps are read
+        returns xt_prediction   tensor  (T - observe_dim, batch_size, 3, 8, 8)
+                st              tensor  (T, batch_size, s_dim)     inferred states of all steps
+    """
+
+    def __init__(self, model, observe_dim=None):
+        super(GTM_SM_Inference, self).__init__()
+        self.enc_zt = model.enc_zt
+        self.enc_zt_mean = model.enc_zt_mean
+        self.enc_zt_std = model.enc_zt_std
+        self.enc_st_matrix = model.enc_st_matrix
+        self.enc_st_sigmoid = model.enc_st_sigmoid
+        self.dec = model.dec
+        self.observe_dim = model.observe_dim if observe_dim is None else observe_dim
+        self.s_dim = model.s_dim
+        self.z_dim = model.z_dim
+        self.k_nearest_neighbour = model.k_nearest_neighbour
+        self.r_std = model.r_std
+        self.delta = model.delta
+
+    def forward(self, x, action_one_hot_value, position) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch_size = x.size(0)
+
+        # st of every step: the same scan as GTM_SM._st_scan
+        replacement = self.enc_st_matrix(action_one_hot_value.transpose(1, 2)).transpose(0, 1)
+        st_noise = torch.randn(replacement.shape, dtype=x.dtype, device=x.device) * self.r_std
+        st_tensor = st_transition_scan(torch.zeros(batch_size, self.s_dim, dtype=x.dtype, device=x.device),
+                                       replacement, st_noise,
+                                       self.enc_st_sigmoid[0].weight, self.enc_st_sigmoid[0].bias,
+                                       self.enc_st_sigmoid[2].weight, self.enc_st_sigmoid[2].bias)
+        st_observation = st_tensor[:self.observe_dim]
+        st_prediction = st_tensor[self.observe_dim:]
+        prediction_dim = st_prediction.size(0)
+
+        # observation phase: encode the glimpses into the spatial memory
+        x_patches = gather_patches(x, position[:, :, :self.observe_dim])
+        zt = self.enc_zt(x_patches.reshape(self.observe_dim * batch_size, 3, 8, 8))
+        zt_mean_observation = self.enc_zt_mean(zt).view(self.observe_dim, batch_size, self.z_dim)
+        zt_std_observation = self.enc_zt_std(zt).view(self.observe_dim, batch_size, self.z_dim)
+
+        # prediction phase: the same neighbour lookup, mixture weights and sampling as GTM_SM.forward in eval mode
+        knn_indices = knn_query(st_observation, st_prediction, self.k_nearest_neighbour)
+        neighbours = gather_neighbours(knn_indices, [st_observation, zt_mean_observation, zt_std_observation])
+        normalized_wk = neighbour_weights(neighbours[0], st_prediction, self.delta)
+        zt_sampling = sample_mixture(normalized_wk, neighbours[1], neighbours[2])
+        xt_prediction = self.dec(zt_sampling.view(-1, self.z_dim)).view(prediction_dim, batch_size, 3, 8, 8)
+
+        return xt_prediction, st_tensor
+
+
+def export(checkpoint, output, observe_dim=None):
+    from predict import load_model
+
+    model = load_model(checkpoint)
+    scripted = torch.jit.script(GTM_SM_Inference(model, observe_dim))
+    scripted.save(output)
+    return scripted
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export GTM-SM to TorchScript')
+    parser.add_argument('--checkpoint', default='saves/gtm_sm_state_dict.pth',
+                        help='trained state dict or training checkpoint of main.py '
+                             '(default: saves/gtm_sm_state_dict.pth)')
+    parser.add_argument('--output', default='saves/gtm_sm_inference.pt',
+                        help='TorchScript artifact to write (default: saves/gtm_sm_inference.pt)')
+    parser.add_argument('--observe-dim', type=int, default=None,
+                        help='number of observed steps (default: the observe_dim of the model)')
+    options = parser.parse_args()
+    export(options.checkpoint, options.output, options.observe_dim)
+    print('Exported model to ' + options.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,144 @@
 import torch
-import torch.nn as nn
-import torch.nn.init as init
-import torchvision
-import argparse
-import torch.nn.functional as F
-import torchvision.transforms as T
 import torch.optim as optim
-from torch.utils.data import DataLoader
-from torch.utils.data import sampler
-import torchvision.datasets as dset
+from torch.nn.parallel import DistributedDataParallel
 
 import os
-import time
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
 
-from multiprocessing import Process
-
-from utils.torch_utils import initNetParams, ChunkSampler, show_images, device_agnostic_selection
+from utils.torch_utils import initNetParams
 from model import GTM_SM
-from config import *
-from show_results import show_experiment_information
+from config import parse_args, seed_everything
 from train import train, test
+from roam import TrajectoryPrefetcher
+from dataset import load_dataset, make_loader, set_epoch
+from execution import ExecutionPolicy
+from spatial_memory import make_knn_backend
+from checkpoint import CheckpointManager, load_checkpoint, rng_state, set_rng_state
+from distributed import launch, init_process_group, destroy_process_group, is_main_process, all_gather_object
+
+def main(argv=None):
+    config = parse_args(argv)
+    launch(run, config.world_size, config)
 
-plt.rcParams['figure.figsize'] = (10.0, 8.0)  # set default size of plots
-plt.rcParams['image.interpolation'] = 'nearest'
-plt.rcParams['image.cmap'] = 'gray'
 
-def main():
-    data_transform = T.Compose([
-        T.Resize((32, 32)),
-        T.ToTensor(),
-    ])
-    training_dataset = dset.ImageFolder(root='./datasets/CelebA/training', transform=data_transform)
-    loader_train = DataLoader(training_dataset, batch_size=args.batch_size, shuffle=True, **kwargs)
+def run(rank, world_size, config):
+    '''train on rank of world_size data-parallel processes, rank 0 alone writes the checkpoints and results'''
+    init_process_group(rank, world_size, config.dist_backend)
+    policy = ExecutionPolicy(config.intra_op_threads, config.inter_op_threads, config.cpu_workers).apply()
+    if is_main_process():
+        print('Execution policy: ' + policy.describe())
+    # the ranks start from different parameters, DistributedDataParallel broadcasts those of rank 0
+    seed_everything(config.seed + rank, config.cuda)
+    device = config.device
+    if config.cuda and world_size > 1:
+        device = torch.device('cuda', rank % torch.cuda.device_count())
+        torch.cuda.set_device(device)
 
-    val_dataset = dset.ImageFolder(root='./datasets/CelebA/val', transform=data_transform)
-    loader_val = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=True, **kwargs)
+    # every rank shuffles with the same seed and takes its own shard of the permutation
+    training_dataset = load_dataset('training', cache_dir=config.dataset_cache)
+    loader_train = make_loader(training_dataset, config.batch_size, shuffle=True, seed=config.seed,
+                               rank=rank, num_replicas=world_size, **config.loader_kwargs)
 
-    GTM_SM_model = GTM_SM(batch_size=args.batch_size, total_dim=256 + 32).to(device=device)
+    val_dataset = load_dataset('val', cache_dir=config.dataset_cache)
+    loader_val = make_loader(val_dataset, config.batch_size, shuffle=True, seed=config.seed + 1,
+                             rank=rank, num_replicas=world_size, **config.loader_kwargs)
+
+    knn = make_knn_backend(config.knn_backend, **({'policy': policy} if config.knn_backend == 'flann' else {}))
+    GTM_SM_model = GTM_SM(batch_size=config.batch_size, total_dim=256 + 32, knn_backend=knn,
+                          precision=config.precision).to(device=device)
     initNetParams(GTM_SM_model)
 
     lr_list = np.linspace(1e-3, 5e-5, num=50000)
     optimizer = optim.Adam(GTM_SM_model.parameters(), lr=lr_list[0])
 
     updating_counter = 0
+    start_epoch = 1
+    walk_start = {'train_walks': 0, 'val_walks': 0}
+
+    train_loss_arr = np.zeros((config.epochs))
+    train_kld_loss_arr = np.zeros((config.epochs))
+    train_nll_loss_arr = np.zeros((config.epochs))
+    test_nll_loss_arr = np.zeros((config.epochs))
 
-    train_loss_arr = np.zeros((args.epochs))
-    train_kld_loss_arr = np.zeros((args.epochs))
-    train_nll_loss_arr = np.zeros((args.epochs))
-    test_nll_loss_arr = np.zeros((args.epochs))
+    # every rank loads the same checkpoint, written by rank 0 at the end of an epoch
+    checkpoints = CheckpointManager(config.checkpoint_dir, config.keep_last, config.keep_best) \
+        if is_main_process() else None
+    if config.resume is not None:
+        path = config.resume
+        if path == 'latest':
+            path = CheckpointManager(config.checkpoint_dir, async_save=False).latest()
+        if path is None:
+            raise FileNotFoundError('no checkpoint to resume from in ' + config.checkpoint_dir)
+        state = load_checkpoint(path, map_location=device)
+        GTM_SM_model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        updating_counter = state['updating_counter']
+        start_epoch = state['epoch'] + 1
+        walk_start = {'train_walks': state['train_walks'], 'val_walks': state['val_walks']}
+        for name, loader in (('loader_train', loader_train), ('loader_val', loader_val)):
+            if hasattr(loader, 'load_state_dict'):
+                loader.load_state_dict(state[name])
+        # the random states are only restored exactly with the same number of ranks
+        if len(state['rng_states']) == world_size:
+            set_rng_state(state['rng_states'][rank])
+        else:
+            seed_everything(config.seed + rank + world_size * start_epoch, config.cuda)
+        for name, history in (('train_loss_arr', train_loss_arr), ('train_kld_loss_arr', train_kld_loss_arr),
+                              ('train_nll_loss_arr', train_nll_loss_arr), ('test_nll_loss_arr', test_nll_loss_arr)):
+            saved = state['history'][name][:config.epochs]
+            history[:len(saved)] = saved
+        if is_main_process():
+            print('Resumed from {} at epoch {}'.format(path, start_epoch))
 
-    for epoch in range(1, args.epochs + 1):
+    # random walks are generated on background threads while the model trains,
+    # every rank draws its own training stream 2 * rank and validation stream 2 * rank + 1
+    train_walks = TrajectoryPrefetcher(GTM_SM_model, config.seed, stream=2 * rank, start=walk_start['train_walks'],
+                                       device=device, policy=policy)
+    val_walks = TrajectoryPrefetcher(GTM_SM_model, config.seed, total_dim=GTM_SM_model.eval_total_dim,
+                                     stream=2 * rank + 1, start=walk_start['val_walks'], device=device, policy=policy)
+
+    model = GTM_SM_model
+    if world_size > 1:
+        model = DistributedDataParallel(GTM_SM_model, device_ids=[device.index] if device.type == 'cuda' else None)
+
+    for epoch in range(start_epoch, config.epochs + 1):
+        set_epoch(loader_train, epoch)
+        set_epoch(loader_val, epoch)
         # training + testing
-        updating_counter = train(epoch, GTM_SM_model, optimizer, loader_train, lr_list, train_loss_arr, train_kld_loss_arr, train_nll_loss_arr, updating_counter)
-        test(epoch, GTM_SM_model, loader_val, test_nll_loss_arr)
-        # saving model
-        if (epoch - 1) % args.save_interval == 0:
-            fn = 'saves/gtm_sm_state_dict_' + str(epoch) + '.pth'
-            torch.save(GTM_SM_model.state_dict(), fn)
-            print('Saved model to ' + fn)
+        updating_counter = train(epoch, model, optimizer, loader_train, lr_list, train_loss_arr, train_kld_loss_arr, train_nll_loss_arr, updating_counter, config, device, train_walks)
+        test(epoch, model, loader_val, test_nll_loss_arr, config, device, val_walks)
+        # saving a checkpoint, the parameters are identical on every rank but the random states are not
+        if (epoch - 1) % config.save_interval == 0 or epoch == config.epochs:
+            rng_states = all_gather_object(rng_state())
+            if is_main_process():
+                state = {
+                    'model': GTM_SM_model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'epoch': epoch,
+                    'updating_counter': updating_counter,
+                    'rng_states': rng_states,
+                    'train_walks': train_walks.index,
+                    'val_walks': val_walks.index,
+                    'loader_train': loader_train.state_dict() if hasattr(loader_train, 'state_dict') else None,
+                    'loader_val': loader_val.state_dict() if hasattr(loader_val, 'state_dict') else None,
+                    'history': {'train_loss_arr': train_loss_arr, 'train_kld_loss_arr': train_kld_loss_arr,
+                                'train_nll_loss_arr': train_nll_loss_arr, 'test_nll_loss_arr': test_nll_loss_arr},
+                }
+                checkpoints.save(state, epoch, metric=test_nll_loss_arr[epoch - 1])
+
+    if checkpoints is not None:
+        checkpoints.close()
+    train_walks.close()
+    val_walks.close()
+    policy.close()
+    destroy_process_group()
+    if rank != 0:
+        return
 
     root = os.getcwd()
     folder_name = "result_folder"
     os.chdir(os.path.join(root, folder_name))
-    np.savez("result.npz", train_loss_arr=train_loss_arr, train_kld_loss_arr=train_kld_loss_arr, train_nll_loss_arr=train_nll_loss_arr, val_nll_loss_arr=val_nll_loss_arr)
+    np.savez("result.npz", train_loss_arr=train_loss_arr, train_kld_loss_arr=train_kld_loss_arr, train_nll_loss_arr=train_nll_loss_arr, val_nll_loss_arr=test_nll_loss_arr)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,20 +1,13 @@
+from typing import List
+
 import torch
 import torch.nn as nn
-from torch.nn import init
-import torchvision
 import torch.nn.functional as F
-import torchvision.transforms as T
-import torch.optim as optim
-
-import time
-import numpy as np
-import pyflann
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
+from torch.utils.checkpoint import checkpoint
 
-from utils.torch_utils import initNetParams, ChunkSampler, show_images, device_agnostic_selection
-from config import *
+from utils.torch_utils import extract_patches
 from roam import random_walk
+from spatial_memory import make_knn_backend
 """implementation of the Generative Temporal Models 
 with Spatial Memory (GTM-SM) from https://arxiv.org/abs/1804.09401
 """
@@ -56,9 +49,69 @@ class Unflatten(nn.Module):
     def forward(self, x):
         return x.view(self.N, self.C, self.H, self.W)
 
+def st_transition_scan(st_0, replacement, noise, w1, b1, w2, b2):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor) -> Tensor
+    """st recurrence st_t = st_{t-1} + r_t * g(st_{t-1} + r_t) + noise_t, with g the two-layer enc_st_sigmoid
+    network given by (w1, b1, w2, b2), for replacement r and noise of shape (T, batch_size, s_dim).
+    Returns the states (T + 1, batch_size, s_dim), starting with st_0, written to a preallocated buffer."""
+    steps = replacement.size(0)
+    st_all = torch.empty([steps + 1, st_0.size(0), st_0.size(1)], dtype=st_0.dtype, device=st_0.device)
+    st = st_0
+    st_all[0] = st
+    for t in range(steps):
+        replacement_t = replacement[t]
+        gate = torch.sigmoid(F.linear(torch.relu(F.linear(st + replacement_t, w1, b1)), w2, b2))
+        st = st + replacement_t * gate + noise[t]
+        st_all[t + 1] = st
+    return st_all
+
+
+_scripted_st_transition_scan = None
+
+
+def scripted_st_transition_scan():
+    """TorchScript version of st_transition_scan, compiled on first use to keep imports fast"""
+    global _scripted_st_transition_scan
+    if _scripted_st_transition_scan is None:
+        _scripted_st_transition_scan = torch.jit.script(st_transition_scan)
+    return _scripted_st_transition_scan
+
+
+def gather_neighbours(knn_indices, memories):
+    # type: (Tensor, List[Tensor]) -> List[Tensor]
+    """gather the k nearest entries of every memory (N, batch_size, d) for knn_indices (batch_size, M, k),
+    each result has the shape (M, batch_size, k, d)"""
+    batch_index = torch.arange(knn_indices.size(0), device=knn_indices.device).view(-1, 1, 1)
+    return [memory[knn_indices, batch_index].transpose(0, 1) for memory in memories]
+
+
+def neighbour_weights(knn_st_memory, st, delta):
+    # type: (Tensor, Tensor, float) -> Tensor
+    """inverse squared distance weights of the neighbours (T, batch_size, k, s_dim) of st (T, batch_size, s_dim),
+    normalized over the k neighbours"""
+    dk2 = ((knn_st_memory - st.unsqueeze(2)) ** 2).sum(3)
+    wk = 1 / (dk2 + delta)
+    return wk / torch.sum(wk, 2, keepdim=True)
+
+
+def sample_mixture(normalized_wk, zt_mean_knn, zt_std_knn):
+    # type: (Tensor, Tensor, Tensor) -> Tensor
+    """draw one zt per (T, batch_size) entry from the mixture of its k neighbours"""
+    cumsum_normalized_wk = torch.cumsum(normalized_wk, dim=2)
+    rand_sample_value = torch.rand([normalized_wk.size(0), normalized_wk.size(1), 1],
+                                   dtype=normalized_wk.dtype, device=normalized_wk.device)
+    knn_sample_index = (cumsum_normalized_wk <= rand_sample_value).sum(2, keepdim=True)
+    knn_sample_index = knn_sample_index.clamp(max=normalized_wk.size(2) - 1).unsqueeze(3).expand(
+        -1, -1, -1, zt_mean_knn.size(3))
+    zt_mean = zt_mean_knn.gather(2, knn_sample_index).squeeze(2)
+    zt_std = zt_std_knn.gather(2, knn_sample_index).squeeze(2)
+    return torch.randn_like(zt_std).mul(zt_std).add(zt_mean)
+
+
 class GTM_SM(nn.Module):
     def __init__(self, x_dim=8, a_dim=5, s_dim=2, z_dim=16, observe_dim=256, total_dim=288, \
-                 r_std=0.001, k_nearest_neighbour=5, delta=0.0001, kl_samples=1000, batch_size=1):
+                 r_std=0.001, k_nearest_neighbour=5, delta=0.0001, kl_samples=1000, batch_size=1, eval_total_dim=512, \
+                 knn_backend='torch', kl_block_numel=2 ** 22, rng=None, precision='float32'):
         super(GTM_SM, self).__init__()
 
         self.x_dim = x_dim
@@ -72,8 +125,19 @@ class GTM_SM(nn.Module):
         self.k_nearest_neighbour = k_nearest_neighbour
         self.delta = delta
         self.kl_samples = kl_samples
+        # upper bound on the number of elements of one Monte Carlo block of the kld estimator
+        self.kl_block_numel = kl_block_numel
+        # numpy RandomState for the random walks generated in forward, the global numpy state if None
+        self.rng = rng
         self.batch_size = batch_size
-        self.flanns = pyflann.FLANN()
+        self.eval_total_dim = eval_total_dim
+        # spatial memory lookup, 'torch' (batched brute force), 'flann' (per-sample kd-trees), 'grid' (hashed cells)
+        # or a KNNBackend instance
+        self.knn = make_knn_backend(knn_backend)
+        # 'bfloat16' runs enc_zt, dec and the gaussian log pdf of the kld in bfloat16, see reduced_dtype
+        if precision not in ('float32', 'bfloat16'):
+            raise ValueError("unknown precision {!r}, expected 'float32' or 'bfloat16'".format(precision))
+        self.precision = precision
 
         # feature-extracting transformations
 
@@ -166,232 +230,265 @@ class GTM_SM(nn.Module):
             Deprocess_img())
         '''
 
-    def forward(self, x):
+    def forward(self, x, trajectory=None, reduction='sum'):
+        """x: images (batch_size, 3, 32, 32), any batch_size
+        trajectory: optional precomputed (action_one_hot_value, position, action_selection),
+        e.g. from roam.TrajectoryPrefetcher, otherwise a random walk is generated here
+        reduction: 'sum' returns the scalar kld_loss and nll_loss of the batch, 'none' returns the per-timestep,
+        per-sample terms of shape (self.total_dim - self.observe_dim, batch_size) instead, with
+        kld_loss = kld.mean(0).sum() and nll_loss = nll.sum(). The kld terms are zero in eval mode."""
+        if reduction not in ('sum', 'none'):
+            raise ValueError("unknown reduction {!r}, expected 'sum' or 'none'".format(reduction))
+        total_dim = self.total_dim if self.training else self.eval_total_dim
+        if trajectory is not None and trajectory[1].shape[2] != total_dim:
+            raise ValueError('the trajectory has {} steps, expected {} in {} mode'.format(
+                trajectory[1].shape[2], total_dim, 'training' if self.training else 'eval'))
         if not self.training:
             origin_total_dim = self.total_dim
-            self.total_dim = 512
+            self.total_dim = self.eval_total_dim
         if len(x.shape) == 3:
             x = x.unsqueeze(0)
+        device = x.device
+        # the batch is sized by the input, self.batch_size only sets the default size of generated walks
+        batch_size = x.size(0)
 
         '''
-        action_one_hot_value        tensor  (self.batch_size, self.a_dim, self.total_dim)
-        position                    np      (self.batch_size, self.s_dim, self.total_dim)
-        action_selection            np      (self.batch_size, self.total_dim)
-        st_observation_list         list    (self.observe_dim)(self.batch_size, self.s_dim)
-        st_prediction_list          list    (self.total_dim - self.observe_dim)(self.batch_size, self.s_dim)
-        zt_mean_observation_list    list    (self.observe_dim)(self.batch_size, self.z_dim)
-        zt_std_observation_list     list    (self.observe_dim)(self.batch_size, self.z_dim)
-        zt_mean_prediction_list     list    (self.total_dim - self.observe_dim)(self.batch_size, self.z_dim)
-        zt_std_prediction_list      list    (self.total_dim - self.observe_dim)(self.batch_size, self.z_dim)
-        xt_prediction_list          list    (self.total_dim - self.observe_dim)(self.batch_size, self.x_dim)
-        xt_ground_true_list         list    (self.total_dim - self.observe_dim)(self.batch_size, self.x_dim)
+        action_one_hot_value        tensor  (batch_size, self.a_dim, self.total_dim)
+        position                    np      (batch_size, self.s_dim, self.total_dim)
+        action_selection            np      (batch_size, self.total_dim)
+        st_observation_list         list    (self.observe_dim)(batch_size, self.s_dim)
+        st_prediction_list          list    (self.total_dim - self.observe_dim)(batch_size, self.s_dim)
+        xt_prediction_list          list    (self.total_dim - self.observe_dim)(batch_size, self.x_dim)
+        xt_ground_true_list         list    (self.total_dim - self.observe_dim)(batch_size, self.x_dim)
 
         after construct them, we will use torch.cat to eliminate the list object
 
-        st_observation_tensor       tensor      (self.observe_dim, self.batch_size, self.s_dim)
-        st_prediction_tensor        tensor      (self.total_dim - self.observe_dim, self.batch_size, self.s_dim)
-        zt_mean_observation_tensor  tensor      (self.observe_dim, self.batch_size, self.z_dim)
-        zt_std_observation_tensor   tensor      (self.observe_dim, self.batch_size, self.z_dim)
-        zt_mean_prediction_tensor   tensor      (self.total_dim - self.observe_dim, self.batch_size, self.z_dim)
-        zt_std_prediction_tensor    tensor      (self.total_dim - self.observe_dim, self.batch_size, self.z_dim)
-        xt_prediction_tensor        tensor      (self.total_dim - self.observe_dim, self.batch_size, self.x_dim)
-        xt_ground_true_tensor       tensor      (self.total_dim - self.observe_dim, self.batch_size, self.x_dim)
+        st_observation_tensor       tensor      (self.observe_dim, batch_size, self.s_dim)
+        st_prediction_tensor        tensor      (self.total_dim - self.observe_dim, batch_size, self.s_dim)
+        zt_mean_observation_tensor  tensor      (self.observe_dim, batch_size, self.z_dim)
+        zt_std_observation_tensor   tensor      (self.observe_dim, batch_size, self.z_dim)
+        zt_mean_prediction_tensor   tensor      (self.total_dim - self.observe_dim, batch_size, self.z_dim)
+        zt_std_prediction_tensor    tensor      (self.total_dim - self.observe_dim, batch_size, self.z_dim)
+        xt_prediction_tensor        tensor      (self.total_dim - self.observe_dim, batch_size, self.x_dim)
+        xt_ground_true_tensor       tensor      (self.total_dim - self.observe_dim, batch_size, self.x_dim)
 
         '''
 
-        action_one_hot_value, position, action_selection = random_walk(self)
-        st_observation_list = []
-        st_prediction_list = []
-        zt_mean_observation_list = []
-        zt_std_observation_list = []
-        zt_mean_prediction_list = []
-        zt_std_prediction_list = []
+        if trajectory is None:
+            trajectory = random_walk(self, self.rng, device, batch_size)
+        # a precomputed trajectory batch may be larger than a final short batch, use its first rows
+        action_one_hot_value, position, action_selection = (value[:batch_size] for value in trajectory)
+        action_one_hot_value = action_one_hot_value.to(device=device)
+        # all glimpses of the trajectory, (self.total_dim, batch_size, 3, 8, 8)
+        x_patches = extract_patches(x, position)
         xt_prediction_list = []
 
         kld_loss = 0
-        nll_loss = 0
-
-        # observation phase: construct st
-        for t in range(self.observe_dim):
-            if t == 0:
-                st_observation_t = torch.zeros(self.batch_size, self.s_dim, device=device)#torch.rand(self.batch_size, self.s_dim, device=device) - 1
-            else:
-                replacement = self.enc_st_matrix(action_one_hot_value[:, :, t - 1])
-                st_observation_t = st_observation_list[t - 1] + replacement * \
-                                   self.enc_st_sigmoid(st_observation_list[t - 1] + replacement) + \
-                                   torch.randn((self.batch_size, self.s_dim), device=device) * self.r_std
-            st_observation_list.append(st_observation_t)
-        st_observation_tensor = torch.cat(st_observation_list, 0).view(self.observe_dim, self.batch_size, self.s_dim)
-
-
-        # prediction phase: construct st
-        for t in range(self.total_dim - self.observe_dim):
-            if t == 0:
-                replacement = self.enc_st_matrix(action_one_hot_value[:, :, t + self.observe_dim - 1])
-                st_prediction_t = st_observation_list[-1] + replacement * \
-                                  self.enc_st_sigmoid(st_observation_list[-1] + replacement) + \
-                                  torch.randn((self.batch_size, self.s_dim), device=device) * self.r_std
-            else:
-                replacement = self.enc_st_matrix(action_one_hot_value[:, :, t + self.observe_dim - 1])
-                st_prediction_t = st_prediction_list[t - 1] + replacement * \
-                                  self.enc_st_sigmoid(st_prediction_list[t - 1] + replacement) + \
-                                  torch.randn((self.batch_size, self.s_dim), device=device) * self.r_std
-            st_prediction_list.append(st_prediction_t)
-        st_prediction_tensor = torch.cat(st_prediction_list, 0).view(self.total_dim - self.observe_dim, self.batch_size,
-                                                                     self.s_dim)
-
-        # observation phase: construct zt from xt
-        for t in range(self.observe_dim):
-            index_mask = torch.zeros((self.batch_size, 3, 32, 32), device=device)
-            for index_sample in range(self.batch_size):
-                position_h_t = position[index_sample, 0, t]
-                position_w_t = position[index_sample, 1, t]
-                index_mask[index_sample, :, 3 * position_h_t:3 * position_h_t + 8,
-                3 * position_w_t:3 * position_w_t + 8] = 1
-            index_mask_bool = index_mask.ge(0.5)
-            x_feed = torch.masked_select(x, index_mask_bool).view(-1, 3, 8, 8)
-            zt_observation_t = self.enc_zt(x_feed)
-            zt_mean_observation_t = self.enc_zt_mean(zt_observation_t)
-            zt_std_observation_t = self.enc_zt_std(zt_observation_t)
-            zt_mean_observation_list.append(zt_mean_observation_t)
-            zt_std_observation_list.append(zt_std_observation_t)
-        zt_mean_observation_tensor = torch.cat(zt_mean_observation_list, 0).view(self.observe_dim, self.batch_size,
-                                                                                 self.z_dim)
-        zt_std_observation_tensor = torch.cat(zt_std_observation_list, 0).view(self.observe_dim, self.batch_size,
-                                                                               self.z_dim)
 
+        # construct st for the observation and prediction phases in one scan:
+        # all enc_st_matrix projections at once, then the sequential part in a fused loop
+        replacement = self.enc_st_matrix(action_one_hot_value.transpose(1, 2)).transpose(0, 1)
+        st_noise = torch.randn(replacement.shape, device=device) * self.r_std
+        st_tensor = self._st_scan(torch.zeros(batch_size, self.s_dim, device=device), replacement, st_noise)
+        st_observation_tensor = st_tensor[:self.observe_dim]
+        st_prediction_tensor = st_tensor[self.observe_dim:]
+        st_observation_list = list(st_observation_tensor.unbind(0))
+        st_prediction_list = list(st_prediction_tensor.unbind(0))
+
+        # construct zt from xt: the observation phase, plus the prediction phase while training,
+        # folded over time into a single encoder call
         if self.training:
-            # prediction phase: construct zt from xt
-            for t in range(self.total_dim - self.observe_dim):
-                index_mask = torch.zeros((self.batch_size, 3, 32, 32), device=device)
-                for index_sample in range(self.batch_size):
-                    position_h_t = position[index_sample, 0, t + self.observe_dim]
-                    position_w_t = position[index_sample, 1, t + self.observe_dim]
-                    index_mask[index_sample, :, 3 * position_h_t:3 * position_h_t + 8,
-                    3 * position_w_t:3 * position_w_t + 8] = 1
-                index_mask_bool = index_mask.ge(0.5)
-                x_feed = torch.masked_select(x, index_mask_bool).view(-1, 3, 8, 8)
-                zt_prediction_t = self.enc_zt(x_feed)
-                zt_mean_prediction_t = self.enc_zt_mean(zt_prediction_t)
-                zt_std_prediction_t = self.enc_zt_std(zt_prediction_t)
-                zt_mean_prediction_list.append(zt_mean_prediction_t)
-                zt_std_prediction_list.append(zt_std_prediction_t)
-            zt_mean_prediction_tensor = torch.cat(zt_mean_prediction_list, 0).view(self.total_dim - self.observe_dim,
-                                                                                   self.batch_size, self.z_dim)
-            zt_std_prediction_tensor = torch.cat(zt_std_prediction_list, 0).view(self.total_dim - self.observe_dim,
-                                                                                 self.batch_size, self.z_dim)
-
-            # reparameterized_sample to calculate the reconstruct error
-            for t in range(self.total_dim - self.observe_dim):
-                zt_prediction_sample = self._reparameterized_sample(zt_mean_prediction_list[t],
-                                                                    zt_std_prediction_list[t])
-                index_mask = torch.zeros((self.batch_size, 3, 32, 32), device=device)
-                for index_sample in range(self.batch_size):
-                    position_h_t = position[index_sample, 0, t + self.observe_dim]
-                    position_w_t = position[index_sample, 1, t + self.observe_dim]
-                    index_mask[index_sample, :, 3 * position_h_t:3 * position_h_t + 8,
-                    3 * position_w_t:3 * position_w_t + 8] = 1
-                index_mask_bool = index_mask.ge(0.5)
-                x_ground_true_t = torch.masked_select(x, index_mask_bool).view(-1, 3, 8, 8)
-                x_resconstruct_t = self.dec(zt_prediction_sample)
-                nll_loss += self._nll_gauss(x_resconstruct_t, x_ground_true_t)
-                xt_prediction_list.append(x_resconstruct_t)
-
-        # construct kd tree
-        st_observation_memory = st_observation_tensor.cpu().detach().numpy()
-        st_prediction_memory = st_prediction_tensor.cpu().detach().numpy()
-
-        results = []
-        for index_sample in range(self.batch_size):
-            param = self.flanns.build_index(st_observation_memory[:, index_sample, :], algorithm='kdtree',
-                                            trees=4)
-            result, _ = self.flanns.nn_index(st_prediction_memory[:, index_sample, :],
-                                             self.k_nearest_neighbour, checks=param["checks"])
-            results.append(result)
+            zt_mean_tensor, zt_std_tensor = self._encode_patches(x_patches)
+        else:
+            zt_mean_tensor, zt_std_tensor = self._encode_patches(x_patches[:self.observe_dim])
+        zt_mean_observation_tensor = zt_mean_tensor[:self.observe_dim]
+        zt_std_observation_tensor = zt_std_tensor[:self.observe_dim]
+
+        if self.training:
+            zt_mean_prediction_tensor = zt_mean_tensor[self.observe_dim:]
+            zt_std_prediction_tensor = zt_std_tensor[self.observe_dim:]
+
+            # reparameterized_sample to calculate the reconstruct error, decoding all steps at once
+            zt_prediction_sample = self._reparameterized_sample(zt_mean_prediction_tensor, zt_std_prediction_tensor)
+            xt_prediction_tensor = self._decode(zt_prediction_sample.view(-1, self.z_dim)).view(
+                self.total_dim - self.observe_dim, batch_size, 3, 8, 8)
+            nll = self._nll_gauss_element(xt_prediction_tensor, x_patches[self.observe_dim:])
+            xt_prediction_list = list(xt_prediction_tensor.unbind(0))
+
+        # look up the spatial memory: k nearest observation states of every predicted state,
+        # knn_indices tensor (batch_size, self.total_dim - self.observe_dim, self.k_nearest_neighbour)
+        knn_indices = self.knn.query(st_observation_tensor, st_prediction_tensor, self.k_nearest_neighbour)
+
+        # mixture weights of the k nearest neighbours, (self.total_dim - self.observe_dim, batch_size, k)
+        knn_st_memory, zt_mean_knn_tensor, zt_std_knn_tensor = gather_neighbours(
+            knn_indices, [st_observation_tensor, zt_mean_observation_tensor, zt_std_observation_tensor])
+        normalized_wk = neighbour_weights(knn_st_memory, st_prediction_tensor, self.delta)
 
         if self.training:
-            # calculate the kld
-            for index_sample in range(self.batch_size):
-                knn_index = results[index_sample]
-                knn_index_vec = np.reshape(knn_index, (self.k_nearest_neighbour * (self.total_dim - self.observe_dim)))
-                knn_st_memory = (st_observation_tensor[knn_index_vec, index_sample]).reshape((self.total_dim - self.observe_dim), \
-                                                                                  self.k_nearest_neighbour, -1)
-                dk2 = ((knn_st_memory.transpose(0, 1) - st_prediction_tensor[:, index_sample, :]) ** 2).sum(2).transpose(0, 1)
-                wk = 1 / (dk2 + self.delta)
-                normalized_wk = (wk.t() / torch.sum(wk, 1)).t()
-                log_normalized_wk = torch.log(normalized_wk)
-                zt_sampling = self._reparameterized_sample_cluster(zt_mean_prediction_tensor[:, index_sample],
-                                                                   zt_std_prediction_tensor[:, index_sample])
-                log_q_phi = - 0.5 * self.z_dim * torch.log(torch.tensor(2 * 3.1415926535, device = device)) - \
-                    0.5 * self.z_dim - torch.log(zt_std_prediction_tensor[:, index_sample]).sum(1)
-                zt_mean_knn_tensor = zt_mean_observation_tensor[knn_index_vec, index_sample].reshape(
-                    (self.total_dim - self.observe_dim), self.k_nearest_neighbour, -1)
-                zt_std_knn_tensor = zt_std_observation_tensor[knn_index_vec, index_sample].reshape(
-                    (self.total_dim - self.observe_dim), self.k_nearest_neighbour, -1)
-
-                log_p_theta_element = self._log_gaussian_element_pdf(zt_sampling, zt_mean_knn_tensor, zt_std_knn_tensor) + \
-                                      log_normalized_wk
-                (log_p_theta_element_max, _) = torch.max(log_p_theta_element, 2)
-                log_p_theta_element_nimus_max = (log_p_theta_element.transpose(1, 2).transpose(0, 1) - log_p_theta_element_max)
-                p_theta_nimus_max = torch.exp(log_p_theta_element_nimus_max).sum(0)
-                kld_loss += torch.mean(log_q_phi - torch.mean(log_p_theta_element_max + torch.log(p_theta_nimus_max), 0))
+            # calculate the kld of all samples at once
+            log_normalized_wk = torch.log(normalized_wk)
+            log_q_phi = - 0.5 * self.z_dim * torch.log(torch.tensor(2 * 3.1415926535, device = device)) - \
+                0.5 * self.z_dim - torch.log(zt_std_prediction_tensor).sum(2)
+            log_p_theta = self._log_mixture_pdf_monte_carlo(zt_mean_prediction_tensor, zt_std_prediction_tensor,
+                                                            zt_mean_knn_tensor, zt_std_knn_tensor, log_normalized_wk)
+            kld = log_q_phi - log_p_theta
+            kld_loss += torch.mean(kld, 0).sum()
         else:
-            xt_prediction_tensor = torch.zeros(self.total_dim - self.observe_dim, self.batch_size, 3, 8, 8,
-                                               device=device)
-            for index_sample in range(self.batch_size):
-                knn_index = results[index_sample]
-                knn_index_vec = np.reshape(knn_index, (self.k_nearest_neighbour * (self.total_dim - self.observe_dim)))
-                knn_st_memory = (st_observation_tensor[knn_index_vec, index_sample]).reshape(
-                    (self.total_dim - self.observe_dim), \
-                    self.k_nearest_neighbour, -1)
-                dk2 = ((knn_st_memory.transpose(0, 1) - st_prediction_tensor[:, index_sample, :]) ** 2).sum(
-                    2).transpose(0, 1)
-                wk = 1 / (dk2 + self.delta)
-                normalized_wk = (wk.t() / torch.sum(wk, 1)).t()
-                cumsum_normalized_wk = torch.cumsum(normalized_wk, dim=1)
-                rand_sample_value = torch.rand((self.total_dim - self.observe_dim, 1), device=device)
-                bool_index_list = cumsum_normalized_wk <= rand_sample_value
-                knn_sample_index = bool_index_list.sum(1)
-                zt_sampling = self._reparameterized_sample(
-                    zt_mean_observation_tensor[knn_index[range(self.total_dim - self.observe_dim), knn_sample_index], index_sample],
-                    zt_std_observation_tensor[knn_index[range(self.total_dim - self.observe_dim), knn_sample_index], index_sample])
-                xt_prediction_tensor[:, index_sample] = self.dec(zt_sampling)
+            # sample zt from the neighbour mixture and decode all prediction steps of all samples at once
+            zt_sampling = sample_mixture(normalized_wk, zt_mean_knn_tensor, zt_std_knn_tensor)
+            xt_prediction_tensor = self._decode(zt_sampling.view(-1, self.z_dim)).view(
+                self.total_dim - self.observe_dim, batch_size, 3, 8, 8)
 
             # calculate the reconstruct error
-            for t in range(self.total_dim - self.observe_dim):
-                index_mask = torch.zeros((self.batch_size, 3, 32, 32), device=device)
-                for index_sample in range(self.batch_size):
-                    position_h_t = position[index_sample, 0, t + self.observe_dim]
-                    position_w_t = position[index_sample, 1, t + self.observe_dim]
-                    index_mask[index_sample, :, 3 * position_h_t:3 * position_h_t + 8,
-                    3 * position_w_t:3 * position_w_t + 8] = 1
-                index_mask_bool = index_mask.ge(0.5)
-                x_ground_true_t = torch.masked_select(x, index_mask_bool).view(-1, 3, 8, 8)
-                nll_loss += self._nll_gauss(xt_prediction_tensor[t], x_ground_true_t)
-
-
-            # reparameterized_sample to calculate the reconstruct error
-            for t in range(self.total_dim - self.observe_dim):
-                xt_prediction_list.append(xt_prediction_tensor[t])
+            nll = self._nll_gauss_element(xt_prediction_tensor, x_patches[self.observe_dim:])
+            xt_prediction_list = list(xt_prediction_tensor.unbind(0))
+            kld = torch.zeros_like(nll)
+        nll_loss = nll.sum()
 
         if not self.training:
             self.total_dim = origin_total_dim
 
+        if reduction == 'none':
+            return kld, nll, st_observation_list, st_prediction_list, xt_prediction_list, position
+
         return kld_loss, nll_loss, st_observation_list, st_prediction_list, xt_prediction_list, position
 
+    def rollout(self, x, candidate_actions, trajectory=None):
+        """Predict several candidate futures of the same observation phase.
+        The first observe_dim glimpses of x along trajectory are encoded once into the spatial memory, then the
+        M candidate action sequences continue from the last observed state, all folded into one batch of
+        M * batch_size for the st scan, the KNN lookup and the decoder.
+        x                       tensor  (batch_size, 3, 32, 32)
+        candidate_actions       tensor  (M, batch_size, H) action indices or (M, batch_size, H, a_dim) one-hot,
+                                        the first one is the move away from the last observed glimpse
+        trajectory              optional (action_one_hot_value, position, action_selection) as in forward, only
+                                its observation phase is used, otherwise a random walk is generated
+        returns xt_prediction   tensor  (M, H, batch_size, 3, 8, 8)
+                st_prediction   tensor  (M, H, batch_size, self.s_dim)
+                st_observation  tensor  (self.observe_dim, batch_size, self.s_dim)
+        """
+        if len(x.shape) == 3:
+            x = x.unsqueeze(0)
+        device = x.device
+        batch_size = x.size(0)
+        if trajectory is None:
+            trajectory = random_walk(self, self.rng, device, batch_size)
+        action_one_hot_value, position, _ = (value[:batch_size] for value in trajectory)
+        action_one_hot_value = action_one_hot_value[:, :, :self.observe_dim - 1].to(device=device)
+
+        # observation phase, encoded once
+        x_patches = extract_patches(x, position[:, :, :self.observe_dim])
+        replacement = self.enc_st_matrix(action_one_hot_value.transpose(1, 2)).transpose(0, 1)
+        st_noise = torch.randn(replacement.shape, device=device) * self.r_std
+        st_observation = self._st_scan(torch.zeros(batch_size, self.s_dim, device=device), replacement, st_noise)
+        zt_mean_observation, zt_std_observation = self._encode_patches(x_patches)
+
+        # candidates folded into the batch, candidate m of sample b at m * batch_size + b
+        if candidate_actions.dim() == 3:
+            candidate_actions = F.one_hot(candidate_actions.long(), self.a_dim)
+        candidates, _, horizon = candidate_actions.shape[:3]
+        candidate_actions = candidate_actions.to(device=device, dtype=torch.float).permute(2, 0, 1, 3).reshape(
+            horizon, candidates * batch_size, self.a_dim)
+        replacement = self.enc_st_matrix(candidate_actions)
+        st_noise = torch.randn(replacement.shape, device=device) * self.r_std
+        st_prediction = self._st_scan(st_observation[-1].repeat(candidates, 1), replacement, st_noise)[1:]
+
+        # every candidate reads the same memory
+        memories = tuple(memory.repeat(1, candidates, 1)
+                         for memory in (st_observation, zt_mean_observation, zt_std_observation))
+        knn_indices = self.knn.query(memories[0], st_prediction, self.k_nearest_neighbour)
+        knn_st_memory, zt_mean_knn, zt_std_knn = gather_neighbours(knn_indices, list(memories))
+        normalized_wk = neighbour_weights(knn_st_memory, st_prediction, self.delta)
+        zt_sampling = sample_mixture(normalized_wk, zt_mean_knn, zt_std_knn)
+        xt_prediction = self._decode(zt_sampling.view(-1, self.z_dim)).view(horizon, candidates, batch_size, 3, 8, 8)
+
+        return xt_prediction.transpose(0, 1), \
+            st_prediction.view(horizon, candidates, batch_size, self.s_dim).transpose(0, 1), st_observation
+
+    def _st_scan(self, st_0, replacement, noise):
+        """run the st recurrence from st_0 (batch_size, s_dim) over replacement and noise (T, batch_size, s_dim)"""
+        return scripted_st_transition_scan()(st_0, replacement, noise,
+                                            self.enc_st_sigmoid[0].weight, self.enc_st_sigmoid[0].bias,
+                                            self.enc_st_sigmoid[2].weight, self.enc_st_sigmoid[2].bias)
+
+    @property
+    def reduced_dtype(self):
+        """dtype of the reduced-precision parts, None in full precision.
+        The logsumexp and log(normalized_wk) of the kld, the st recurrence and the losses always stay in float32."""
+        if self.precision == 'float32':
+            return None
+        if self.precision == 'bfloat16':
+            return torch.bfloat16
+        raise ValueError("unknown precision {!r}, expected 'float32' or 'bfloat16'".format(self.precision))
+
+    def _autocast(self, device):
+        return torch.autocast(device.type, dtype=self.reduced_dtype or torch.bfloat16,
+                              enabled=self.reduced_dtype is not None)
+
+    def _decode(self, zt):
+        """decode zt (N, z_dim) into float32 crops (N, 3, 8, 8)"""
+        with self._autocast(zt.device):
+            return self.dec(zt).float()
+
+    def _encode_patches(self, patches):
+        """encode (T, batch_size, 3, 8, 8) crops into zt mean and std of shape (T, batch_size, z_dim)"""
+        T, batch_size = patches.shape[:2]
+        with self._autocast(patches.device):
+            zt = self.enc_zt(patches.reshape(T * batch_size, 3, 8, 8)).float()
+        zt_mean = self.enc_zt_mean(zt).view(T, batch_size, self.z_dim)
+        zt_std = self.enc_zt_std(zt).view(T, batch_size, self.z_dim)
+        return zt_mean, zt_std
+
     def _log_gaussian_pdf(self, zt, zt_mean, zt_std):
-        constant_value = torch.tensor(2 * 3.1415926535, device = device)
+        constant_value = torch.tensor(2 * 3.1415926535, device = zt.device)
         log_exp_term = - torch.sum((((zt - zt_mean) ** 2) / (zt_std ** 2) / 2.0), 2)
         log_other_term = - (self.z_dim / 2.0) * torch.log(constant_value) - torch.sum(torch.log(zt_std), 1)
         return log_exp_term + log_other_term
 
     def _log_gaussian_element_pdf(self, zt, zt_mean, zt_std):
-        constant_value = torch.tensor(2 * 3.1415926535, device = device)
-        zt_repeat = zt.unsqueeze(2).repeat(1, 1, self.k_nearest_neighbour, 1)
-        log_exp_term = - torch.sum((((zt_repeat - zt_mean) ** 2) / (zt_std ** 2) / 2.0), 3)
-        log_other_term = - (self.z_dim / 2.0) * torch.log(constant_value) - torch.sum(torch.log(zt_std), 2)
+        """log pdf of zt (..., z_dim) under each of the k gaussians (..., k, z_dim), broadcast to (..., k)"""
+        constant_value = torch.tensor(2 * 3.1415926535, device = zt.device)
+        log_exp_term = - torch.sum((((zt.unsqueeze(-2) - zt_mean) ** 2) / (zt_std ** 2) / 2.0), -1)
+        log_other_term = - (self.z_dim / 2.0) * torch.log(constant_value) - torch.sum(torch.log(zt_std), -1)
         return log_exp_term + log_other_term
 
+    def _log_mixture_block(self, samples, zt_mean, zt_std, zt_mean_knn, zt_std_knn, log_normalized_wk):
+        # eps is drawn here rather than passed in, so checkpoint does not keep it alive until backward,
+        # its preserved rng state replays the same draw when the block is recomputed
+        eps = torch.randn((samples,) + zt_mean.shape, device=zt_mean.device)
+        zt_sampling = eps.mul(zt_std).add(zt_mean)
+        if self.reduced_dtype is not None:
+            zt_sampling, zt_mean_knn, zt_std_knn = (value.to(self.reduced_dtype)
+                                                    for value in (zt_sampling, zt_mean_knn, zt_std_knn))
+        log_p_theta_element = self._log_gaussian_element_pdf(zt_sampling, zt_mean_knn, zt_std_knn).float() + \
+            log_normalized_wk
+        return torch.logsumexp(log_p_theta_element, -1).sum(0)
+
+    def _log_mixture_pdf_monte_carlo(self, zt_mean, zt_std, zt_mean_knn, zt_std_knn, log_normalized_wk):
+        """Monte Carlo estimate of E_q[log p_theta(z)], q = N(zt_mean, zt_std) of shape (T, batch_size, z_dim) and
+        p_theta the mixture of the k neighbours (T, batch_size, k, z_dim) weighted by log_normalized_wk (T, batch_size, k).
+        The self.kl_samples samples are processed in blocks of at most self.kl_block_numel elements, each block
+        recomputed during backward. The noise of a block is drawn inside it, so only the per-step statistics are
+        saved for backward and peak memory stays flat as kl_samples grows. Returns (T, batch_size)."""
+        T, batch_size, k, z_dim = zt_mean_knn.shape
+        steps_per_block = max(1, min(T, self.kl_block_numel // (batch_size * k * z_dim)))
+        log_p_theta = []
+        for t in range(0, T, steps_per_block):
+            block = slice(t, t + steps_per_block)
+            block_inputs = (zt_mean[block], zt_std[block], zt_mean_knn[block], zt_std_knn[block], log_normalized_wk[block])
+            block_steps = block_inputs[0].size(0)
+            samples_per_block = max(1, min(self.kl_samples, self.kl_block_numel // (block_steps * batch_size * k * z_dim)))
+            log_p_theta_sum = 0
+            for sample in range(0, self.kl_samples, samples_per_block):
+                samples = min(samples_per_block, self.kl_samples - sample)
+                if torch.is_grad_enabled():
+                    log_p_theta_sum = log_p_theta_sum + checkpoint(self._log_mixture_block, samples, *block_inputs,
+                                                                   use_reentrant=False)
+                else:
+                    log_p_theta_sum = log_p_theta_sum + self._log_mixture_block(samples, *block_inputs)
+            log_p_theta.append(log_p_theta_sum / self.kl_samples)
+        return torch.cat(log_p_theta, 0)
+
     def reset_parameters(self, stdv=1e-1):
         for weight in self.parameters():
             weight.data.normal_(0, stdv)
@@ -402,13 +499,7 @@ class GTM_SM(nn.Module):
 
     def _reparameterized_sample(self, mean, std):
         """using std to sample"""
-        eps = torch.randn_like(std, device = device)
-        return eps.mul(std).add(mean)
-
-
-    def _reparameterized_sample_cluster(self, mean, std):
-        """using std to sample"""
-        eps = torch.randn((self.kl_samples, self.total_dim - self.observe_dim, self.z_dim), device=device)
+        eps = torch.randn_like(std)
         return eps.mul(std).add(mean)
 
 
@@ -422,6 +513,10 @@ class GTM_SM(nn.Module):
     def _nll_bernoulli(self, theta, x):
         return - torch.sum(x * torch.log(theta) + (1 - x) * torch.log(1 - theta))
 
+    def _nll_gauss_element(self, x, mean):
+        """squared error of every crop, x and mean (T, batch_size, ...) summed to (T, batch_size)"""
+        return ((x - mean) ** 2).flatten(2).sum(2)
+
     def _nll_gauss(self, x, mean):
         # n, _ = x.size()
         return torch.sum((x - mean) ** 2)
\ No newline at end of file
@@ -0,0 +1,74 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from model import GTM_SM
+
+"""lightweight inference entry point. It only needs torch and numpy: plotting, torchvision datasets and pyflann
+are never imported, so short-lived batch jobs start quickly.
+
+    python predict.py images.npy --output predictions.npz
+
+images.npy holds an array of shape (N, 3, 32, 32), uint8 in [0, 255] or float in [0, 1].
+"""
+
+
+def load_model(checkpoint='saves/gtm_sm_state_dict.pth', device='cpu', **kwargs):
+    '''build a GTM_SM in eval mode from a saved state dict or a training checkpoint of checkpoint.py,
+    kwargs are passed to the constructor'''
+    state_dict = torch.load(checkpoint, map_location=lambda storage, loc: storage, weights_only=False)
+    if 'model' in state_dict:
+        state_dict = state_dict['model']
+    model = GTM_SM(**kwargs)
+    model.load_state_dict(state_dict)
+    model.to(device=device)
+    model.eval()
+    return model
+
+
+def predict(model, images, batch_size=16, device='cpu'):
+    '''run the model over images (N, 3, 32, 32) in batches, each along a random walk drawn from model.rng,
+    yields dicts with the predicted crops, the inferred states and the positions of every batch'''
+    with torch.no_grad():
+        for start in range(0, len(images), batch_size):
+            x = torch.from_numpy(np.array(images[start:start + batch_size])).to(device=device)
+            if x.dtype == torch.uint8:
+                x = x.float() / 255
+            kld_loss, nll_loss, st_observation_list, st_prediction_list, xt_prediction_list, position = model(x)
+            yield {
+                'xt_prediction': torch.stack(xt_prediction_list, 1).cpu().numpy(),
+                'st': torch.stack(st_observation_list + st_prediction_list, 1).cpu().numpy(),
+                'position': position,
+                'nll_loss': nll_loss.item(),
+            }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='GTM-SM inference')
+    parser.add_argument('images', help='.npy file of images with shape (N, 3, 32, 32)')
+    parser.add_argument('--output', default='predictions.npz', help='where to write the predictions')
+    parser.add_argument('--checkpoint', default='saves/gtm_sm_state_dict.pth', help='trained state dict')
+    parser.add_argument('--batch-size', type=int, default=16, metavar='N')
+    parser.add_argument('--seed', type=int, default=1, metavar='S')
+    parser.add_argument('--no-cuda', action='store_true', default=False)
+    options = parser.parse_args(argv)
+
+    device = torch.device("cuda" if not options.no_cuda and torch.cuda.is_available() else "cpu")
+    torch.manual_seed(options.seed)
+
+    start_time = time.time()
+    model = load_model(options.checkpoint, device, rng=np.random.RandomState(options.seed))
+    images = np.load(options.images, mmap_mode='r')
+    results = list(predict(model, images, options.batch_size, device))
+    np.savez(options.output,
+             xt_prediction=np.concatenate([result['xt_prediction'] for result in results]),
+             st=np.concatenate([result['st'] for result in results]),
+             position=np.concatenate([result['position'] for result in results]))
+    print('Predicted {} images in {:.2f}s, written to {}'.format(len(images), time.time() - start_time,
+                                                                   options.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+"""headless rendering of the image navigation videos.
+
+    python render.py --samples 16 --format gif --output-dir videos/rendered
+
+Every frame shows the image with the red box of the current 8 x 8 crop, the observed crop, the predicted crop,
+the true positions and the inferred states. The figure and its artists are built once per episode and updated
+in place with set_data, the frames are blitted by the Agg backend and streamed to an MP4 (ffmpeg) or GIF (Pillow)
+writer, so rendering needs neither a display nor pyplot. render_batch renders many episodes in worker processes.
+"""
+
+
+def episode_arrays(model, x, st_observation_list, st_prediction_list, xt_prediction_list, position, sample_id):
+    '''the numpy arrays of sample sample_id of a forward pass, everything render_episode needs.
+    A plain dict of arrays, so it can be sent to a worker process.'''
+    st = np.stack([st[sample_id].cpu().detach().numpy() for st in st_observation_list + st_prediction_list])
+    return {
+        'image': x[sample_id].cpu().detach().numpy().transpose(1, 2, 0),
+        'position': np.asarray(position[sample_id]),
+        'st': st,
+        'xt_prediction': np.stack([xt[sample_id].cpu().detach().numpy().transpose(1, 2, 0)
+                                   for xt in xt_prediction_list]) if xt_prediction_list else None,
+        'observe_dim': model.observe_dim,
+    }
+
+
+def boxed_frames(image, position, patch_size=8, stride=3):
+    '''the image (H, W, 3) with a red box around the crop of every step, (T, H, W, 3), for positions (2, T)'''
+    height, width = image.shape[:2]
+    top = stride * position[0][:, None, None]
+    left = stride * position[1][:, None, None]
+    rows = np.arange(height)[None, :, None]
+    columns = np.arange(width)[None, None, :]
+    inside = (rows >= top) & (rows < top + patch_size) & (columns >= left) & (columns < left + patch_size)
+    border = inside & ((rows == top) | (rows == top + patch_size - 1) |
+                       (columns == left) | (columns == left + patch_size - 1))
+    frames = np.repeat(image[None], position.shape[1], 0)
+    frames[border] = (1.0, 0.0, 0.0)
+    return frames
+
+
+def crops(image, position, patch_size=8, stride=3):
+    '''the crop (T, patch_size, patch_size, 3) of every step'''
+    rows = stride * position[0][:, None, None] + np.arange(patch_size)[None, :, None]
+    columns = stride * position[1][:, None, None] + np.arange(patch_size)[None, None, :]
+    return image[rows, columns]
+
+
+class EpisodeFigure(object):
+    """The five panels of show_results, built once on figure and updated in place by update(t).
+    frame(t) returns the RGBA pixels of step t drawn by blitting: the static parts (axes, labels, ticks) are
+    rendered once per phase and only the changing artists are drawn on top of a copy of them."""
+
+    def __init__(self, figure, episode):
+        from matplotlib import gridspec
+
+        self.figure = figure
+        self.episode = episode
+        self.observe_dim = episode['observe_dim']
+        position = episode['position']
+        st = episode['st']
+        self.frames = boxed_frames(episode['image'], position)
+        self.observations = crops(episode['image'], position)
+        blank = np.zeros((8, 8, 3))
+
+        st_max = st.max(0)
+        st_min = st.min(0)
+        margin = (st_max - st_min) / 10.0
+
+        grid = gridspec.GridSpec(20, 20)
+        self.title = figure.suptitle('', fontsize=25)
+
+        ax1 = figure.add_subplot(grid[1:10, 1:10])
+        ax1.set_axis_off()
+        self.image_artist = ax1.imshow(self.frames[0])
+
+        ax2 = figure.add_subplot(grid[4:8, 11:15])
+        ax2.set_axis_off()
+        ax2.set_title('Observation')
+        self.observation_artist = ax2.imshow(self.observations[0])
+
+        self.ax3 = figure.add_subplot(grid[4:8, 16:20])
+        self.ax3.set_axis_off()
+        self.ax3.set_title('Prediction')
+        self.prediction_artist = self.ax3.imshow(blank)
+        self.ax3.set_visible(False)
+
+        ax4 = figure.add_subplot(grid[11:20, 1:10])
+        ax4.set_xlabel('x')
+        ax4.set_ylabel('y')
+        ax4.set_title('True states')
+        ax4.set_aspect('equal')
+        ax4.axis([-1, 9, -1, 9])
+        ax4.invert_yaxis()
+        self.position_path, = ax4.plot([], [], color='k', linestyle='solid', marker='o')
+        self.position_marker, = ax4.plot([], [], 'bs')
+
+        ax5 = figure.add_subplot(grid[11:20, 11:20])
+        ax5.set_xlabel('$s_1$')
+        ax5.set_ylabel('$s_2$')
+        ax5.set_title('Inferred states')
+        ax5.axis([st_min[1] - margin[1], st_max[1] + margin[1], st_min[0] - margin[0], st_max[0] + margin[0]])
+        ax5.invert_yaxis()
+        self.st_path, = ax5.plot([], [], color='k', linestyle='solid', marker='o')
+        self.st_marker, = ax5.plot([], [], 'bs')
+
+        self.artists = (self.title, self.image_artist, self.observation_artist, self.prediction_artist,
+                        self.position_path, self.position_marker, self.st_path, self.st_marker)
+        self.backgrounds = {}
+
+    def __len__(self):
+        return self.episode['position'].shape[1]
+
+    def update(self, t):
+        position = self.episode['position']
+        st = self.episode['st']
+        observing = t < self.observe_dim
+        self.title.set_text('t = {}\n{}'.format(t, 'OBSERVATION PHASE' if observing else 'PREDICTION PHASE'))
+        self.image_artist.set_data(self.frames[t])
+        self.observation_artist.set_data(self.observations[t])
+        if not observing and self.episode['xt_prediction'] is not None:
+            self.ax3.set_visible(True)
+            self.prediction_artist.set_data(np.clip(self.episode['xt_prediction'][t - self.observe_dim], 0, 1))
+
+        # the paths grow during the observation phase and stay at the observed part afterwards
+        path_end = t + 1 if observing else self.observe_dim + 1
+        self.position_path.set_data(position[1, :path_end], position[0, :path_end])
+        self.position_marker.set_data(position[1, t:t + 1], position[0, t:t + 1])
+        path_end = t + 1 if observing else self.observe_dim
+        self.st_path.set_data(st[:path_end, 1], st[:path_end, 0])
+        self.st_marker.set_data(st[t:t + 1, 1], st[t:t + 1, 0])
+
+    def frame(self, t):
+        '''the figure at step t as an (height, width, 4) uint8 array, requires an Agg canvas.
+        The array is a view of the canvas buffer, valid until the next frame.'''
+        self.update(t)
+        canvas = self.figure.canvas
+        observing = t < self.observe_dim
+        if observing not in self.backgrounds:
+            # the static parts of this phase, the changing artists are left out while drawing them
+            for artist in self.artists:
+                artist.set_animated(True)
+            canvas.draw()
+            self.backgrounds[observing] = canvas.copy_from_bbox(self.figure.bbox)
+        canvas.restore_region(self.backgrounds[observing])
+        for artist in self.artists:
+            if artist.axes is None or artist.axes.get_visible():
+                self.figure.draw_artist(artist)
+        return np.asarray(canvas.buffer_rgba())
+
+
+class GifWriter(object):
+    """streams the frames into an animated GIF, each frame is encoded and written as soon as it arrives.
+    The palette is quantized once from the first frame and written as the global color table, every frame is
+    only mapped onto it, so no frame needs a color table of its own."""
+
+    def __init__(self, output, fps):
+        self.file = open(output, 'wb')
+        self.duration = int(round(1000.0 / fps))
+        self.palette = None
+
+    def write(self, frame):
+        from PIL import Image, GifImagePlugin
+        image = Image.fromarray(frame[:, :, :3])
+        if self.palette is None:
+            self.palette = image.quantize(256)
+            header, _ = GifImagePlugin.getheader(self.palette.copy(), info={'loop': 0, 'duration': self.duration})
+            self.file.write(b''.join(header))
+        image = image.quantize(palette=self.palette, dither=Image.Dither.NONE)
+        self.file.write(b''.join(GifImagePlugin.getdata(image, duration=self.duration)))
+
+    def close(self):
+        if not self.file.closed:
+            self.file.write(b';')  # trailer
+            self.file.close()
+
+
+class FFMpegWriter(object):
+    """streams raw RGBA frames into an ffmpeg process encoding H.264"""
+
+    def __init__(self, output, fps, size):
+        import subprocess
+        width, height = size
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgba',
+             '-s', '{}x{}'.format(width, height), '-r', str(fps), '-i', '-',
+             '-vcodec', 'libx264', '-pix_fmt', 'yuv420p', output], stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('ffmpeg exited with status {}'.format(self.process.returncode))
+
+
+def make_writer(output, fps, size):
+    '''a Pillow writer for .gif and an ffmpeg writer otherwise, size is (width, height) of the frames'''
+    if output.endswith('.gif'):
+        return GifWriter(output, fps)
+    return FFMpegWriter(output, fps, size)
+
+
+def render_episode(episode, output, fps=20, dpi=80, figsize=(10.0, 8.0)):
+    '''render one episode (see episode_arrays) to the video file output, returns output'''
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=figsize, dpi=dpi)
+    canvas = FigureCanvasAgg(figure)
+    episode_figure = EpisodeFigure(figure, episode)
+    writer = make_writer(output, fps, canvas.get_width_height())
+    try:
+        for t in range(len(episode_figure)):
+            writer.write(episode_figure.frame(t))
+    finally:
+        writer.close()
+    return output
+
+
+def render_batch(episodes, outputs, workers=None, **kwargs):
+    '''render the episodes to the outputs in parallel worker processes, kwargs are passed to render_episode'''
+    from concurrent.futures import ProcessPoolExecutor
+
+    if workers == 0:
+        return [render_episode(episode, output, **kwargs) for episode, output in zip(episodes, outputs)]
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(render_episode, episode, output, **kwargs)
+                   for episode, output in zip(episodes, outputs)]
+        return [future.result() for future in futures]
+
+
+def main(argv=None):
+    import torch
+    from predict import load_model
+    from dataset import load_dataset, make_loader
+
+    parser = argparse.ArgumentParser(description='render GTM-SM image navigation videos')
+    parser.add_argument('--checkpoint', default='saves/gtm_sm_state_dict.pth', help='trained state dict')
+    parser.add_argument('--dataset-cache', default='./datasets/CelebA_32x32', metavar='DIR')
+    parser.add_argument('--output-dir', default='videos/rendered')
+    parser.add_argument('--format', default='mp4', choices=['mp4', 'gif'])
+    parser.add_argument('--samples', type=int, default=16, help='number of test images to render')
+    parser.add_argument('--workers', type=int, default=None, help='rendering processes (default: one per core)')
+    parser.add_argument('--fps', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1, metavar='S')
+    options = parser.parse_args(argv)
+
+    torch.manual_seed(options.seed)
+    model = load_model(options.checkpoint, rng=np.random.RandomState(options.seed))
+    loader = make_loader(load_dataset('testing', cache_dir=options.dataset_cache), options.samples,
+                         shuffle=True, seed=options.seed)
+    x, _ = next(iter(loader))
+    with torch.no_grad():
+        _, _, st_observation_list, st_prediction_list, xt_prediction_list, position = model(x)
+    episodes = [episode_arrays(model, x, st_observation_list, st_prediction_list, xt_prediction_list, position,
+                               sample_id) for sample_id in range(len(x))]
+
+    os.makedirs(options.output_dir, exist_ok=True)
+    outputs = [os.path.join(options.output_dir, 'sample_{}.{}'.format(sample_id, options.format))
+               for sample_id in range(len(x))]
+    start_time = time.time()
+    render_batch(episodes, outputs, options.workers, fps=options.fps)
+    print('Rendered {} videos in {:.2f}s to {}'.format(len(outputs), time.time() - start_time, options.output_dir))
+
+
+if __name__ == "__main__":
+    main()
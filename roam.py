@@ -1,74 +1,195 @@
 import torch
 import numpy as np
-from config import *
+import queue
+import threading
+from types import SimpleNamespace
 
-def random_walk(model):
+# displacement (h, w) of the four moving actions: right, left, up, down. Action 4 means staying still.
+ACTION_MOVES = np.array([[0, 1], [0, -1], [-1, 0], [1, 0]], np.int32)
+
+
+def random_walk(model, rng=None, device=None, batch_size=None, policy=None):
+    '''Generate a batch of random trajectories of the 8 x 8 crop over the 9 x 9 grid of positions.
+    Every sample starts at the centre, repeatedly picks one of the moves that stays on the grid and keeps
+    it for a Poisson(2) number of steps, stopping early if it reaches the border.
+    The whole batch advances together, so the only Python loop is over time.
+    rng is a numpy RandomState (default: the global numpy state), device that of the returned action tensor,
+    batch_size the number of walks (default: model.batch_size).
+    With an ExecutionPolicy that has cpu workers, the batch is split into one chunk per worker, each walked
+    from its own seed drawn from rng, so the result is still reproducible from rng.
+    '''
+    if rng is None:
+        rng = np.random
+    if batch_size is None:
+        batch_size = model.batch_size
+
+    if policy is None or policy.pool is None:
+        position, action_selection = _walk(batch_size, model.s_dim, model.total_dim, rng)
+    else:
+        chunk_sizes = [len(chunk) for chunk in np.array_split(np.arange(batch_size), policy.cpu_workers) if len(chunk)]
+        seeds = rng.randint(2 ** 31, size=len(chunk_sizes))
+        chunks = list(policy.pool.map(_walk_chunk, chunk_sizes, [model.s_dim] * len(chunk_sizes),
+                                      [model.total_dim] * len(chunk_sizes), seeds))
+        position = np.concatenate([chunk[0] for chunk in chunks])
+        action_selection = np.concatenate([chunk[1] for chunk in chunks])
+
+    action_one_hot_value_numpy = np.ascontiguousarray(
+        np.eye(model.a_dim, dtype=np.float32)[action_selection].transpose(0, 2, 1))
+    action_one_hot_value = torch.from_numpy(action_one_hot_value_numpy)
+    if device is not None:
+        action_one_hot_value = action_one_hot_value.to(device=device)
+
+    return action_one_hot_value, position, action_selection
+
+
+def _walk_chunk(batch_size, s_dim, total_dim, seed):
+    # runs in a worker process, so it has to be a picklable top-level function
+    return _walk(batch_size, s_dim, total_dim, np.random.RandomState(seed))
+
+
+def _walk(batch_size, s_dim, total_dim, rng):
+    '''positions (batch_size, s_dim, total_dim) and actions (batch_size, total_dim - 1) of random_walk'''
     # construct position and action
-    action_one_hot_value_numpy = np.zeros((model.batch_size, model.a_dim, model.total_dim - 1), np.float32)
-    position = np.zeros((model.batch_size, model.s_dim, model.total_dim), np.int32)
-    action_selection = np.zeros((model.batch_size, model.total_dim - 1), np.int32)
-    for index_sample in range(model.batch_size):
+    position = np.zeros((batch_size, s_dim, total_dim), np.int32)
+    action_selection = np.zeros((batch_size, total_dim - 1), np.int32)
+    position[:, :, 0] = 4
+
+    current_action = np.zeros(batch_size, np.int64)
+    action_duriation = np.zeros(batch_size, np.int64)
+    need_to_stop = np.zeros(batch_size, bool)
+    new_continue_action_flag = np.ones(batch_size, bool)
+    for t in range(1, total_dim):
+        previous_position = position[:, :, t - 1]
+        if new_continue_action_flag.any():
+            # uniform choice among the moves that keep the crop inside the image,
+            # the same distribution as rejection sampling over all four moves
+            valid_action = np.stack([previous_position[:, 1] != 8, previous_position[:, 1] != 0,
+                                     previous_position[:, 0] != 0, previous_position[:, 0] != 8], 1)
+            action_score = np.where(valid_action, rng.random_sample((batch_size, 4)), -1.0)
+            current_action = np.where(new_continue_action_flag, action_score.argmax(1), current_action)
+            action_duriation = np.where(new_continue_action_flag, rng.poisson(2, batch_size), action_duriation)
+            need_to_stop &= ~new_continue_action_flag
+
+        active = action_duriation > 0
+        target_position = previous_position + ACTION_MOVES[current_action]
+        blocked = ((target_position < 0) | (target_position > 8)).any(1)
+        need_to_stop |= active & blocked
+        moving = active & ~need_to_stop
+
+        position[:, :, t] = np.where(moving[:, None], target_position, previous_position)
+        action_selection[:, t - 1] = np.where(active, current_action, 4)
+        action_duriation = action_duriation - active
+        new_continue_action_flag = action_duriation <= 0
+
+    return position, action_selection
+
+
+def _walk_reference(batch_size, s_dim, total_dim, rng):
+    '''the original one-sample-at-a-time walk with rejection sampling of the moves, same outputs as _walk.
+    Too slow for training, kept as the reference distribution for python benchmark.py walk.'''
+    position = np.zeros((batch_size, s_dim, total_dim), np.int32)
+    action_selection = np.zeros((batch_size, total_dim - 1), np.int32)
+    for index_sample in range(batch_size):
+        position[index_sample, :, 0] = 4
         new_continue_action_flag = True
-        for t in range(model.total_dim):
-            if t == 0:
-                #position[index_sample, :, t] = np.random.randint(0, 9, size=(2))
-                position[index_sample, :, t] = np.ones(2) * 4
+        for t in range(1, total_dim):
+            previous_position = position[index_sample, :, t - 1]
+            if new_continue_action_flag:
+                new_continue_action_flag = False
+                need_to_stop = False
+                while 1:
+                    action_random_selection = rng.randint(0, 4)
+                    target_position = previous_position + ACTION_MOVES[action_random_selection]
+                    if ((target_position >= 0) & (target_position <= 8)).all():
+                        break
+                action_duriation = rng.poisson(2)
+
+            if action_duriation > 0:
+                target_position = previous_position + ACTION_MOVES[action_random_selection]
+                if not need_to_stop and not ((target_position >= 0) & (target_position <= 8)).all():
+                    need_to_stop = True
+                position[index_sample, :, t] = previous_position if need_to_stop else target_position
+                action_duriation -= 1
+                action_selection[index_sample, t - 1] = action_random_selection
             else:
-                if new_continue_action_flag:
-                    new_continue_action_flag = False
-                    need_to_stop = False
-
-                    while 1:
-                        action_random_selection = np.random.randint(0, 4, size=(1))
-                        if not (action_random_selection == 0 and position[index_sample, 1, t - 1] == 8):
-                            if not (action_random_selection == 1 and position[index_sample, 1, t - 1] == 0):
-                                if not (action_random_selection == 2 and position[index_sample, 0, t - 1] == 0):
-                                    if not (action_random_selection == 3 and position[index_sample, 0, t - 1] == 8):
-                                        break
-
-                    #action_random_selection = np.random.randint(0, 5, size=(1))
-                    action_duriation = np.random.poisson(2, 1)
-
-                if action_duriation > 0:
-                    if not need_to_stop:
-                        if action_random_selection == 0:
-                            if position[index_sample, 1, t - 1] == 8:
-                                need_to_stop = True
-                                position[index_sample, :, t] = position[index_sample, :, t - 1]
-                            else:
-                                position[index_sample, :, t] = position[index_sample, :, t - 1] + np.array([0, 1])
-                        elif action_random_selection == 1:
-                            if position[index_sample, 1, t - 1] == 0:
-                                need_to_stop = True
-                                position[index_sample, :, t] = position[index_sample, :, t - 1]
-                            else:
-                                position[index_sample, :, t] = position[index_sample, :, t - 1] + np.array([0, -1])
-                        elif action_random_selection == 2:
-                            if position[index_sample, 0, t - 1] == 0:
-                                need_to_stop = True
-                                position[index_sample, :, t] = position[index_sample, :, t - 1]
-                            else:
-                                position[index_sample, :, t] = position[index_sample, :, t - 1] + np.array([-1, 0])
-                        elif action_random_selection == 3:
-                            if position[index_sample, 0, t - 1] == 8:
-                                need_to_stop = True
-                                position[index_sample, :, t] = position[index_sample, :, t - 1]
-                            else:
-                                position[index_sample, :, t] = position[index_sample, :, t - 1] + np.array([1, 0])
-                    else:
-                        position[index_sample, :, t] = position[index_sample, :, t - 1]
-                    action_duriation -= 1
-                    action_selection[index_sample, t - 1] = action_random_selection
-                else:
-                    action_selection[index_sample, t - 1] = 4
-                    position[index_sample, :, t] = position[index_sample, :, t - 1]
-                if action_duriation <= 0:
-                    new_continue_action_flag = True
-
-    for index_sample in range(model.batch_size):
-        action_one_hot_value_numpy[
-            index_sample, action_selection[index_sample], np.array(range(model.total_dim - 1))] = 1
-
-    action_one_hot_value = torch.from_numpy(action_one_hot_value_numpy).to(device=device)
-
-    return action_one_hot_value, position, action_selection
\ No newline at end of file
+                action_selection[index_sample, t - 1] = 4
+                position[index_sample, :, t] = previous_position
+            if action_duriation <= 0:
+                new_continue_action_flag = True
+
+    return position, action_selection
+
+
+class TrajectoryPrefetcher(object):
+    '''Keeps a bounded queue of ready (action_one_hot_value, position, action_selection) batches,
+    filled by a background thread so that random walks are generated while the previous step runs.
+    An error raised while generating a batch stops the thread and is raised again by get().
+    Batch `index` of a stream is always drawn from RandomState([seed, stream, index]), so the sequence
+    of trajectories is reproducible and can be resumed from any `start` index.
+    Arguments:
+        model: GTM_SM instance providing batch_size, a_dim and s_dim, shorter input batches use the first walks
+        seed: base random seed, normally the seed of the Config
+        total_dim: trajectory length (default: model.total_dim)
+        stream: id separating independent streams with the same seed, e.g. training and validation
+        capacity: maximum number of batches waiting in the queue
+        start: index of the first batch to generate
+        device: device of the action tensors
+        policy: ExecutionPolicy whose cpu workers generate the walks, see random_walk
+    '''
+
+    def __init__(self, model, seed, total_dim=None, stream=0, capacity=4, start=0, device=None, policy=None):
+        self.spec = SimpleNamespace(batch_size=model.batch_size, a_dim=model.a_dim, s_dim=model.s_dim,
+                                    total_dim=model.total_dim if total_dim is None else total_dim)
+        self.seed = seed
+        self.stream = stream
+        self.device = device
+        self.policy = policy
+        self.index = start
+        self.queue = queue.Queue(maxsize=capacity)
+        self.error = None
+        self.stop_event = threading.Event()
+        self.worker = threading.Thread(target=self._fill, args=(start,), daemon=True)
+        self.worker.start()
+
+    def _fill(self, index):
+        while not self.stop_event.is_set():
+            try:
+                rng = np.random.RandomState([self.seed, self.stream, index])
+                trajectory = random_walk(self.spec, rng, self.device, policy=self.policy)
+            except Exception as error:
+                # e.g. a broken process pool of the policy, None wakes up a get() waiting for the batch
+                self.error = error
+                trajectory = None
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(trajectory, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if trajectory is None:
+                return
+            index += 1
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('generating the trajectory batch {} failed'.format(self.index)) from self.error
+
+    def get(self):
+        '''return the next trajectory batch, blocking until it is ready'''
+        trajectory = self.queue.get()
+        if trajectory is None:
+            # leave the marker for the next call, the thread has stopped
+            self.queue.put(None)
+            self._check()
+        self.index += 1
+        return trajectory
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    def close(self):
+        self.stop_event.set()
+        self.worker.join()
@@ -1,55 +1,131 @@
-import torch
-import torch.nn as nn
-import torch.nn.init as init
-import torchvision
-import torch.nn.functional as F
-import torchvision.transforms as T
-import torch.optim as optim
-from torch.utils.data import DataLoader
-from torch.utils.data import sampler
-import torchvision.datasets as dset
-
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-
-from utils.torch_utils import initNetParams, ChunkSampler, show_images, device_agnostic_selection
-from model import GTM_SM
-from config import *
-from show_results import show_experiment_information
-
-plt.rcParams['figure.figsize'] = (10.0, 8.0)  # set default size of plots
-plt.rcParams['image.interpolation'] = 'nearest'
-plt.rcParams['image.cmap'] = 'gray'
-
-#load data
-data_transform = T.Compose([
-        T.Resize((32, 32)),
-        T.ToTensor(),
-    ])
-testing_dataset = dset.ImageFolder(root='./datasets/CelebA/testing',
-                                           transform=data_transform)
-loader_val = DataLoader(testing_dataset, batch_size=args.batch_size, shuffle=True)
-
-if torch.cuda.is_available():
-    state_dict = torch.load('saves/GTM_SM_state_dict.pth')
-else:
-    state_dict = torch.load('saves/GTM_SM_state_dict.pth', map_location=lambda storage, loc: storage)
-GTM_SM_model = GTM_SM(batch_size = args.batch_size)
-GTM_SM_model.load_state_dict(state_dict)
-GTM_SM_model.to(device=device)
-
-
-def sample():
-    GTM_SM_model.eval()
-    with torch.no_grad():
-        for batch_idx, (data, _) in enumerate(loader_val):
-
-            #transforming data
-            training_data = data.to(device=device)
-            #forward
-            kld_loss, nll_loss, st_observation_list, st_prediction_list, xt_prediction_list, position = GTM_SM_model(training_data)
-
-            show_experiment_information(GTM_SM_model, data, st_observation_list, st_prediction_list, xt_prediction_list, position)
-
-sample()
\ No newline at end of file
+import os
+import time
+
+import numpy as np
+import torch
+
+from config import Config, build_parser, seed_everything
+from predict import load_model
+from dataset import load_dataset, make_loader
+
+
+def sample(model, loader_val, device):
+    import matplotlib.pyplot as plt
+    from show_results import show_experiment_information
+
+    plt.rcParams['figure.figsize'] = (10.0, 8.0)  # set default size of plots
+    plt.rcParams['image.interpolation'] = 'nearest'
+    plt.rcParams['image.cmap'] = 'gray'
+
+    model.eval()
+    with torch.no_grad():
+        for batch_idx, (data, _) in enumerate(loader_val):
+
+            #transforming data
+            training_data = data.to(device=device)
+            #forward
+            kld_loss, nll_loss, st_observation_list, st_prediction_list, xt_prediction_list, position = model(training_data)
+
+            show_experiment_information(model, data, st_observation_list, st_prediction_list, xt_prediction_list, position)
+
+
+class ShardWriter(object):
+    '''Buffers per-sample arrays and writes them to output_dir/shard_<n>.npz once shard_size samples are buffered,
+    so memory stays bounded by one shard whatever the size of the split.'''
+
+    def __init__(self, output_dir, shard_size=1024):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.buffers = {}
+        self.buffered = 0
+        self.shards = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, **arrays):
+        '''append a batch, every array has the samples along its first dimension'''
+        for name, array in arrays.items():
+            self.buffers.setdefault(name, []).append(array)
+        self.buffered += len(next(iter(arrays.values())))
+        if self.buffered >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        path = os.path.join(self.output_dir, 'shard_{:05d}.npz'.format(self.shards))
+        np.savez(path, **{name: np.concatenate(arrays) for name, arrays in self.buffers.items()})
+        self.buffers = {}
+        self.buffered = 0
+        self.shards += 1
+
+
+def evaluate(model, loader_val, device, output_dir, shard_size=1024):
+    '''score model over the whole loader without plotting. Streams to npz shards under output_dir, per sample:
+        index           int64   position of the image in the split, the loader is expected not to shuffle
+        nll             float32 prediction phase reconstruction error, the summand of nll_loss
+        nll_per_step    float32 (T_pred,) its breakdown over the prediction steps
+        xt_prediction   uint8   (T_pred, 3, 8, 8) predicted crops, scaled to [0, 255]
+        st              float32 (T, s_dim) inferred states of all steps
+        position        int8    (s_dim, T) positions of the crops
+    returns the mean nll per image'''
+    writer = ShardWriter(output_dir, shard_size)
+    model.eval()
+    total_nll = 0
+    samples = 0
+    start_time = time.time()
+    with torch.no_grad():
+        for batch_idx, (data, _) in enumerate(loader_val):
+            data = data.to(device=device)
+            kld, nll_per_step, st_observation_list, st_prediction_list, xt_prediction_list, position = model(
+                data, reduction='none')
+
+            xt_prediction = torch.stack(xt_prediction_list, 1)
+            nll = nll_per_step.sum(0)
+            writer.write(index=np.arange(samples, samples + len(data)),
+                         nll=nll.cpu().numpy(),
+                         nll_per_step=nll_per_step.t().cpu().numpy(),
+                         xt_prediction=(xt_prediction.clamp(0, 1) * 255).round().to(torch.uint8).cpu().numpy(),
+                         st=torch.stack(st_observation_list + st_prediction_list, 1).cpu().numpy(),
+                         position=position.astype(np.int8))
+            total_nll += nll.sum().item()
+            samples += len(data)
+            if batch_idx % 50 == 0:
+                print('Evaluated {} images, {:.1f} images/s'.format(samples, samples / (time.time() - start_time)))
+    writer.flush()
+
+    seconds = time.time() - start_time
+    print('====> Evaluated {} images in {:.2f}s ({:.1f} images/s), mean NLL {:.4f}, {} shards in {}'.format(
+        samples, seconds, samples / seconds, total_nll / samples, writer.shards, output_dir))
+    return total_nll / samples
+
+
+def main(argv=None):
+    parser = build_parser()
+    parser.add_argument('--evaluate', default=None, metavar='DIR',
+                        help='score the whole testing split without plotting, writing the per-sample losses, '
+                             'predictions and states to npz shards in DIR')
+    parser.add_argument('--shard-size', type=int, default=1024, metavar='N',
+                        help='samples per npz shard of --evaluate (default: 1024)')
+    options = vars(parser.parse_args(argv))
+    output_dir = options.pop('evaluate')
+    shard_size = options.pop('shard_size')
+    config = Config(**options)
+    seed_everything(config.seed, config.cuda)
+    device = config.device
+
+    #load data, in order when evaluating so that the shards follow the split
+    testing_dataset = load_dataset('testing', cache_dir=config.dataset_cache)
+    loader_val = make_loader(testing_dataset, config.batch_size, shuffle=output_dir is None, seed=config.seed)
+
+    GTM_SM_model = load_model('saves/gtm_sm_state_dict.pth', device, batch_size=config.batch_size,
+                              knn_backend=config.knn_backend, precision=config.precision,
+                              rng=np.random.RandomState(config.seed))
+
+    if output_dir is None:
+        sample(GTM_SM_model, loader_val, device)
+    else:
+        evaluate(GTM_SM_model, loader_val, device, output_dir, shard_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import torch
+import torch.nn.functional as F
+
+from model import gather_neighbours, neighbour_weights, sample_mixture
+from spatial_memory import GridSpatialMemory
+
+"""incremental inference for agents that move one step at a time.
+
+    session = GTMSMSession(load_model())
+    session.observe(crop)                       # first glimpse, at st = 0
+    session.observe(crop, action)               # every following glimpse with the action that led to it
+    xt_prediction, st_prediction = session.predict(actions)
+
+GTM_SM.forward re-encodes the whole observation phase for every call. A session instead keeps the state st,
+the zt mean / std of every observed glimpse and optionally a grid index of the states, so observing a step
+costs one st transition, one encoder call on a single crop and one index insertion, and predicting T steps costs
+T transitions, one KNN query and one decoder call.
+"""
+
+
+class GTMSMSession(object):
+    """Stateful observe / predict interface over a trained GTM_SM, for batch_size independent agents.
+    Arguments:
+        model: trained GTM_SM, switched to eval mode
+        batch_size: number of agents
+        device: device of the buffers (default: that of the model parameters)
+        index: 'knn' searches the observed states with the KNN backend of the model on every prediction,
+            'grid' keeps an incremental GridSpatialMemory instead, faster once several thousand glimpses
+            have been observed (see python benchmark.py knn)
+        capacity: initial number of steps of the buffers, grown by doubling
+    Actions are either one-hot tensors (batch_size, a_dim) or action indices (batch_size,) as in roam.py:
+    0 right, 1 left, 2 up, 3 down, 4 stay. Crops are (batch_size, 3, 8, 8) in [0, 1].
+    """
+
+    def __init__(self, model, batch_size=1, device=None, index='knn', capacity=256):
+        self.model = model.eval()
+        self.batch_size = batch_size
+        self.device = next(model.parameters()).device if device is None else torch.device(device)
+        self.index = index
+        self.capacity = capacity
+        self.reset()
+
+    def reset(self):
+        '''forget every observation, the next observed glimpse is again taken at st = 0'''
+        model = self.model
+        self.size = 0
+        self.st = torch.zeros(self.batch_size, model.s_dim, device=self.device)
+        self.st_memory = torch.zeros(self.capacity, self.batch_size, model.s_dim, device=self.device)
+        self.zt_mean_memory = torch.zeros(self.capacity, self.batch_size, model.z_dim, device=self.device)
+        self.zt_std_memory = torch.zeros(self.capacity, self.batch_size, model.z_dim, device=self.device)
+        self.grid = GridSpatialMemory(self.batch_size, model.s_dim, capacity=self.capacity) \
+            if self.index == 'grid' else None
+
+    def __len__(self):
+        return self.size
+
+    def _one_hot(self, actions):
+        '''one-hot float actions (..., a_dim) from indices (...) or one-hot actions'''
+        actions = torch.as_tensor(actions, device=self.device)
+        if actions.dtype in (torch.int32, torch.int64):
+            actions = F.one_hot(actions.long(), self.model.a_dim)
+        return actions.float()
+
+    def _transition(self, st, actions):
+        '''states (T, batch_size, s_dim) reached from st by the one-hot actions (T, batch_size, a_dim)'''
+        replacement = self.model.enc_st_matrix(actions)
+        noise = torch.randn(replacement.shape, device=self.device) * self.model.r_std
+        return self.model._st_scan(st, replacement, noise)[1:]
+
+    def _grow(self, size):
+        capacity = self.st_memory.size(0)
+        if size > capacity:
+            while capacity < size:
+                capacity *= 2
+            for name in ('st_memory', 'zt_mean_memory', 'zt_std_memory'):
+                memory = getattr(self, name)
+                grown = memory.new_zeros((capacity,) + memory.shape[1:])
+                grown[:self.size] = memory[:self.size]
+                setattr(self, name, grown)
+
+    def observe(self, crop, action=None):
+        '''add the glimpse crop (batch_size, 3, 8, 8) to the memory. action is the move that led to it from the
+        previous glimpse, None for the first glimpse. Returns the inferred state (batch_size, s_dim).'''
+        with torch.no_grad():
+            if action is not None:
+                if self.size == 0:
+                    raise ValueError('the first glimpse is observed at st = 0, without an action')
+                self.st = self._transition(self.st, self._one_hot(action).unsqueeze(0))[0]
+            crop = torch.as_tensor(crop, device=self.device).float().view(1, self.batch_size, 3, 8, 8)
+            zt_mean, zt_std = self.model._encode_patches(crop)
+
+            self._grow(self.size + 1)
+            self.st_memory[self.size] = self.st
+            self.zt_mean_memory[self.size] = zt_mean[0]
+            self.zt_std_memory[self.size] = zt_std[0]
+            if self.grid is not None:
+                self.grid.append(self.st.cpu().numpy())
+            self.size += 1
+        return self.st
+
+    def predict(self, actions):
+        '''imagine the glimpses along actions (T, batch_size) or (T, batch_size, a_dim) from the current state,
+        without changing the session. Returns the predicted crops (T, batch_size, 3, 8, 8) and their states
+        (T, batch_size, s_dim).'''
+        model = self.model
+        k = model.k_nearest_neighbour
+        if self.size < k:
+            raise ValueError('{} glimpses observed, at least k={} are needed to predict'.format(self.size, k))
+        with torch.no_grad():
+            st_prediction = self._transition(self.st, self._one_hot(actions))
+            steps = st_prediction.size(0)
+            if self.grid is not None:
+                knn_indices = torch.from_numpy(self.grid.query(st_prediction.cpu().numpy(), k)).to(self.device)
+            else:
+                knn_indices = model.knn.query(self.st_memory[:self.size], st_prediction, k)
+
+            knn_st_memory, zt_mean_knn, zt_std_knn = gather_neighbours(
+                knn_indices, [self.st_memory[:self.size], self.zt_mean_memory[:self.size],
+                              self.zt_std_memory[:self.size]])
+            normalized_wk = neighbour_weights(knn_st_memory, st_prediction, model.delta)
+            zt_sampling = sample_mixture(normalized_wk, zt_mean_knn, zt_std_knn)
+            xt_prediction = model._decode(zt_sampling.view(-1, model.z_dim)).view(steps, self.batch_size, 3, 8, 8)
+        return xt_prediction, st_prediction
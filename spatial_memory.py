@@ -0,0 +1,333 @@
+import torch
+import numpy as np
+
+"""k-nearest-neighbour backends used by GTM_SM to look up its spatial memory.
+Every backend answers, for every sample of the batch, the k observation states
+that are closest to each queried state.
+"""
+
+
+class KNNBackend(object):
+    """Interface of a spatial memory KNN backend.
+    query(memory, queries, k)
+        memory      tensor  (N, batch_size, s_dim)      states stored in the memory
+        queries     tensor  (M, batch_size, s_dim)      states to look up
+        returns     tensor  (batch_size, M, k)          long indices into the first dimension of memory,
+                                                        on the device of memory, nearest first
+    """
+
+    def query(self, memory, queries, k):
+        raise NotImplementedError
+
+
+def knn_query(memory, queries, k):
+    # type: (Tensor, Tensor, int) -> Tensor
+    """exact k nearest neighbours with cdist + topk, same arguments and result as KNNBackend.query.
+    Scriptable, so the TorchScript export of export.py runs the same search."""
+    # the matmul formulation of cdist loses precision far from the origin, the states are only 2-D anyway
+    distance = torch.cdist(queries.detach().transpose(0, 1), memory.detach().transpose(0, 1),
+                           compute_mode='donot_use_mm_for_euclid_dist')
+    return torch.topk(distance, k, dim=2, largest=False, sorted=True)[1]
+
+
+class TorchKNN(KNNBackend):
+    """Exact batched brute-force search with cdist + topk, kept on the device of the memory."""
+
+    def query(self, memory, queries, k):
+        with torch.no_grad():
+            return knn_query(memory, queries, k)
+
+
+class FlannKNN(KNNBackend):
+    """Per-sample pyflann kd-trees, rebuilt on every query.
+    With an ExecutionPolicy that has cpu workers, the samples are built and searched in the worker processes."""
+
+    def __init__(self, algorithm='kdtree', trees=4, policy=None):
+        import pyflann
+        self.flanns = pyflann.FLANN()
+        self.algorithm = algorithm
+        self.trees = trees
+        self.policy = policy
+
+    def query(self, memory, queries, k):
+        memory_numpy = memory.cpu().detach().numpy()
+        queries_numpy = queries.cpu().detach().numpy()
+        batch_size = memory_numpy.shape[1]
+        memories = [np.ascontiguousarray(memory_numpy[:, index_sample, :]) for index_sample in range(batch_size)]
+        queries_list = [np.ascontiguousarray(queries_numpy[:, index_sample, :]) for index_sample in range(batch_size)]
+        if self.policy is None or self.policy.pool is None:
+            results = [_flann_query(memory_sample, queries_sample, k, self.algorithm, self.trees, self.flanns)
+                       for memory_sample, queries_sample in zip(memories, queries_list)]
+        else:
+            results = list(self.policy.pool.map(_flann_query, memories, queries_list, [k] * batch_size,
+                                                 [self.algorithm] * batch_size, [self.trees] * batch_size))
+        return torch.from_numpy(np.stack(results).astype(np.int64)).to(device=memory.device)
+
+
+def _flann_query(memory, queries, k, algorithm, trees, flanns=None):
+    """k nearest rows of memory (N, s_dim) of every query (M, s_dim), (M, k).
+    A top-level function so that it can run in the worker processes of an ExecutionPolicy."""
+    if flanns is None:
+        import pyflann
+        flanns = pyflann.FLANN()
+    param = flanns.build_index(memory, algorithm=algorithm, trees=trees)
+    result, _ = flanns.nn_index(queries, k, checks=param["checks"])
+    return np.reshape(result, (queries.shape[0], k))
+
+
+class GridSpatialMemory(object):
+    """Persistent, incrementally updatable 2-D spatial memory for long roaming episodes.
+    States are hashed into uniform grid cells. Every stored step is keyed by its sample and cell, and the keys
+    are kept sorted, so the steps of any cell are found with a binary search.
+    By default the side of the cells adapts to the states of every sample: it is chosen so that a stored state
+    shares its cell with about `occupancy` others on average, and chosen again whenever the number of stored
+    steps has doubled, so the rebuilds cost O(log N) per step amortised.
+    Appending a step costs O(batch_size), the new keys are merged into the sorted index by the next query.
+    query() answers the exact k nearest steps of all samples and queries together: it visits the rings of
+    cells around every query at once and stops each query once its k-th distance is inside the covered radius.
+    Queries still open after max_rings rings, far away from the stored states, are answered by brute force.
+    Arguments:
+        batch_size: number of independent samples (memories)
+        s_dim: dimension of the states, only 2 is supported
+        cell_size: fixed side of the grid cells in the units of the states, None adapts it to the states
+        capacity: initial number of steps the state buffer can hold, grown by doubling
+        occupancy: target mean number of states sharing the cell of a stored state, with adaptive cells
+        max_rings: number of rings of cells visited before falling back to brute force
+    """
+
+    # a key packs the sample and the two cell coordinates, shifted to be non-negative, into one int64
+    CELL_BITS = 21
+    CELL_OFFSET = 1 << (CELL_BITS - 1)
+    # adaptive cells are searched among extent * 2 ** (-e / 2) for e up to MAX_REFINEMENT
+    MAX_REFINEMENT = 24
+
+    def __init__(self, batch_size, s_dim=2, cell_size=None, capacity=1024, occupancy=4, max_rings=8):
+        if s_dim != 2:
+            raise ValueError('GridSpatialMemory only supports 2-D states, got s_dim={}'.format(s_dim))
+        self.batch_size = batch_size
+        self.s_dim = s_dim
+        self.adaptive = cell_size is None
+        self.occupancy = occupancy
+        self.max_rings = max_rings
+        self.size = 0
+        self.states = np.zeros((batch_size, capacity, s_dim), np.float32)
+        # cells of sample b are floor((state - origin[b]) / cell_size[b])
+        self.cell_size = np.full(batch_size, np.nan if cell_size is None else cell_size, np.float64)
+        self.origin = np.zeros((batch_size, s_dim), np.float64)
+        # sorted keys and the step of every key, covering the first `indexed` steps
+        self.sorted_keys = np.zeros(0, np.int64)
+        self.sorted_steps = np.zeros(0, np.int64)
+        self.indexed = 0
+        # number of steps when the adaptive cell sizes were last chosen
+        self.tuned = 0
+        # bounding box of the occupied cells of every sample, (batch_size, min/max, s_dim)
+        self.cell_extent = np.zeros((batch_size, 2, s_dim), np.int64)
+
+    def __len__(self):
+        return self.size
+
+    def _cells(self, states, samples):
+        '''cells (..., 2) of the states (..., 2) of samples (...)'''
+        return np.floor((states - self.origin[samples]) / self.cell_size[samples][..., None]).astype(np.int64)
+
+    def _keys(self, samples, cells):
+        '''keys of the cells (..., 2) of samples (...), -1 for cells outside the representable range'''
+        shifted = cells + self.CELL_OFFSET
+        inside = ((shifted >= 0) & (shifted < 1 << self.CELL_BITS)).all(-1)
+        keys = (samples << (2 * self.CELL_BITS)) | (shifted[..., 0] << self.CELL_BITS) | shifted[..., 1]
+        return np.where(inside, keys, -1)
+
+    def _reserve(self, size):
+        capacity = self.states.shape[1]
+        if size > capacity:
+            while capacity < size:
+                capacity *= 2
+            states = np.zeros((self.batch_size, capacity, self.s_dim), np.float32)
+            states[:, :self.size] = self.states[:, :self.size]
+            self.states = states
+
+    def append(self, states):
+        """store one step, states of shape (batch_size, s_dim)"""
+        self.extend(states[None])
+
+    def extend(self, states):
+        """store several steps, states of shape (T, batch_size, s_dim)"""
+        if torch.is_tensor(states):
+            states = states.cpu().detach().numpy()
+        states = np.asarray(states, np.float32).transpose(1, 0, 2)
+        steps = states.shape[1]
+        self._reserve(self.size + steps)
+        self.states[:, self.size:self.size + steps] = states
+        self.size += steps
+
+    def _step_keys(self, start, stop):
+        '''keys and cells of the steps start:stop of every sample, (batch_size, stop - start) and (..., 2)'''
+        samples = np.arange(self.batch_size)[:, None]
+        cells = self._cells(self.states[:, start:stop], samples)
+        return self._keys(samples, cells), cells
+
+    def _mean_occupancy(self, cell_size):
+        '''mean number of stored states in the cell of a stored state of every sample, for cells of cell_size'''
+        self.cell_size = cell_size
+        keys = np.sort(self._step_keys(0, self.size)[0].ravel())
+        unique_keys, counts = np.unique(keys, return_counts=True)
+        return np.bincount(unique_keys >> (2 * self.CELL_BITS), counts.astype(np.float64) ** 2,
+                           minlength=self.batch_size) / self.size
+
+    def _tune(self):
+        '''choose the cell size of every sample: the largest extent * 2 ** (-e / 2) whose mean occupancy is at
+        most self.occupancy, by a bisection over e done for all samples at once'''
+        states = self.states[:, :self.size]
+        low = states.min(1).astype(np.float64)
+        extent = np.maximum((states.max(1) - low).max(1), 1e-6)
+        self.origin = low
+        lower = np.zeros(self.batch_size, np.int64)
+        upper = np.full(self.batch_size, self.MAX_REFINEMENT)
+        while (lower < upper).any():
+            middle = (lower + upper) // 2
+            fits = self._mean_occupancy(extent * 2.0 ** (-middle / 2)) <= self.occupancy
+            open_search = lower < upper
+            upper = np.where(open_search & fits, middle, upper)
+            lower = np.where(open_search & ~fits, middle + 1, lower)
+        self.cell_size = extent * 2.0 ** (-lower / 2)
+        self.tuned = self.size
+
+    def _update_index(self):
+        '''bring the sorted index up to date with the stored steps'''
+        if self.indexed == self.size:
+            return
+        if self.adaptive and self.size >= 2 * self.tuned:
+            self._tune()
+            self.indexed = 0
+        keys, cells = self._step_keys(self.indexed, self.size)
+        if (keys < 0).any():
+            if not self.adaptive:
+                raise ValueError('states beyond {} cells from the origin cannot be stored'.format(self.CELL_OFFSET))
+            # a state far outside the tuned extent, choose the cells again from all states
+            self._tune()
+            self.indexed = 0
+            keys, cells = self._step_keys(0, self.size)
+        steps = np.broadcast_to(np.arange(self.indexed, self.size), keys.shape).ravel()
+        keys = keys.ravel()
+        order = np.argsort(keys, kind='stable')
+        if self.indexed == 0:
+            self.sorted_keys, self.sorted_steps = keys[order], steps[order]
+            self.cell_extent[:, 0] = cells.min(1)
+            self.cell_extent[:, 1] = cells.max(1)
+        else:
+            positions = np.searchsorted(self.sorted_keys, keys[order], side='right')
+            self.sorted_keys = np.insert(self.sorted_keys, positions, keys[order])
+            self.sorted_steps = np.insert(self.sorted_steps, positions, steps[order])
+            self.cell_extent[:, 0] = np.minimum(self.cell_extent[:, 0], cells.min(1))
+            self.cell_extent[:, 1] = np.maximum(self.cell_extent[:, 1], cells.max(1))
+        self.indexed = self.size
+
+    @staticmethod
+    def _ring(ring):
+        '''offsets (8 * ring, 2) of the cells at chebyshev distance ring, [[0, 0]] for ring 0'''
+        if ring == 0:
+            return np.zeros((1, 2), np.int64)
+        side = np.arange(-ring, ring + 1)
+        inner = np.arange(-ring + 1, ring)
+        return np.concatenate([
+            np.stack([np.full_like(side, -ring), side], 1), np.stack([np.full_like(side, ring), side], 1),
+            np.stack([inner, np.full_like(inner, -ring)], 1), np.stack([inner, np.full_like(inner, ring)], 1)])
+
+    def _brute_force(self, points, samples, k, block_numel=2 ** 22):
+        '''exact k nearest stored steps of points (A, s_dim) of samples (A,) against all the steps, (A, k)'''
+        rows_per_block = max(1, block_numel // (self.size * self.s_dim))
+        knn_index = np.zeros((len(points), k), np.int64)
+        for start in range(0, len(points), rows_per_block):
+            block = slice(start, start + rows_per_block)
+            distance = ((self.states[samples[block], :self.size] - points[block, None]) ** 2).sum(2)
+            nearest = np.argpartition(distance, k - 1, axis=1)[:, :k]
+            order = np.argsort(np.take_along_axis(distance, nearest, 1), axis=1, kind='stable')
+            knn_index[block] = np.take_along_axis(nearest, order, 1)
+        return knn_index
+
+    def query(self, queries, k):
+        """exact k nearest stored steps of every query, queries of shape (M, batch_size, s_dim),
+        returns long indices of shape (batch_size, M, k), nearest first"""
+        if torch.is_tensor(queries):
+            queries = queries.cpu().detach().numpy()
+        if self.size < k:
+            raise ValueError('the spatial memory holds {} states, fewer than k={}'.format(self.size, k))
+        self._update_index()
+        queries = np.asarray(queries, np.float32)
+        num_queries = queries.shape[0]
+        # one row per (sample, query) pair, row index_sample * num_queries + index_query
+        points = queries.transpose(1, 0, 2).reshape(-1, self.s_dim)
+        samples = np.repeat(np.arange(self.batch_size), num_queries)
+        centres = self._cells(points, samples)
+        # number of rings needed to cover every occupied cell of the sample
+        extent = self.cell_extent[samples]
+        max_ring = np.maximum(np.abs(extent[:, 0] - centres), np.abs(extent[:, 1] - centres)).max(1)
+
+        best_distance = np.full((len(points), k), np.inf, np.float32)
+        best_step = np.zeros((len(points), k), np.int64)
+        active = np.arange(len(points))
+        ring = 0
+        while active.size and ring <= self.max_rings:
+            offsets = self._ring(ring)
+            keys = self._keys(samples[active, None], centres[active, None] + offsets)
+            low = np.searchsorted(self.sorted_keys, keys, side='left').ravel()
+            counts = np.searchsorted(self.sorted_keys, keys, side='right').ravel() - low
+            counts[keys.ravel() < 0] = 0
+            if counts.any():
+                # every stored step of the visited cells, with the position in active of its query
+                owner = np.repeat(np.repeat(np.arange(active.size), len(offsets)), counts)
+                first = np.repeat(low - np.cumsum(counts) + counts, counts)
+                steps = self.sorted_steps[first + np.arange(len(first))]
+                rows = active[owner]
+                distance = ((self.states[samples[rows], steps] - points[rows]) ** 2).sum(1)
+
+                # keep the k nearest of the previous best and the new candidates of every query
+                candidate_owner = np.concatenate([np.repeat(np.arange(active.size), k), owner])
+                candidate_distance = np.concatenate([best_distance[active].ravel(), distance])
+                candidate_step = np.concatenate([best_step[active].ravel(), steps])
+                order = np.lexsort((candidate_distance, candidate_owner))
+                group_start = np.searchsorted(candidate_owner[order], np.arange(active.size))
+                nearest = order[group_start[:, None] + np.arange(k)]
+                best_distance[active] = candidate_distance[nearest]
+                best_step[active] = candidate_step[nearest]
+
+            # every state closer than ring * cell_size has been visited
+            covered = ring * self.cell_size[samples[active]]
+            done = (best_distance[active, -1] <= covered ** 2) | (ring >= max_ring[active])
+            active = active[~done]
+            ring += 1
+
+        if active.size:
+            best_step[active] = self._brute_force(points[active], samples[active], k)
+        return best_step.reshape(self.batch_size, num_queries, k)
+
+
+class GridKNN(KNNBackend):
+    """Exact search through a GridSpatialMemory built from the whole memory on every query.
+    Inside GTM_SM.forward this rebuilds the index for every batch and is slower than the brute-force 'torch'
+    backend at the usual memory sizes (see python benchmark.py knn). The grid pays off as the persistent,
+    incremental index of long sessions (session.GTMSMSession), where it is built once and only appended to."""
+
+    def __init__(self, cell_size=None):
+        self.cell_size = cell_size
+
+    def query(self, memory, queries, k):
+        grid = GridSpatialMemory(memory.shape[1], memory.shape[2], cell_size=self.cell_size,
+                                 capacity=memory.shape[0])
+        grid.extend(memory)
+        return torch.from_numpy(grid.query(queries, k)).to(device=memory.device)
+
+
+KNN_BACKENDS = {
+    'torch': TorchKNN,
+    'flann': FlannKNN,
+    'grid': GridKNN,
+}
+
+
+def make_knn_backend(name='torch', **kwargs):
+    if isinstance(name, KNNBackend):
+        return name
+    if name not in KNN_BACKENDS:
+        raise ValueError('unknown KNN backend {!r}, expected one of {}'.format(name, sorted(KNN_BACKENDS)))
+    return KNN_BACKENDS[name](**kwargs)
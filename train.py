@@ -1,33 +1,37 @@
 import torch
-import torch.nn as nn
-import torch.nn.init as init
-import torchvision
-import argparse
-import torch.nn.functional as F
-import torchvision.transforms as T
-import torch.optim as optim
-from torch.utils.data import DataLoader
-from torch.utils.data import sampler
-import torchvision.datasets as dset
-
-import os
-import time
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-
-from multiprocessing import Process
-
-from utils.torch_utils import initNetParams, ChunkSampler, show_images, device_agnostic_selection
-from model import GTM_SM
-from config import *
-from show_results import show_experiment_information
-
-def train(epoch, model, optimizer, loader_train, lr_list, train_loss_arr, train_kld_loss_arr, train_nll_loss_arr, updating_counter):
+
+from distributed import all_reduce_sum, get_world_size, is_main_process
+
+
+class MetricAccumulator(object):
+    """Running sums of named scalar losses kept on the device, so adding a batch never waits for the device.
+    flush() copies the sums to the host in one transfer, adds them to the epoch totals and returns the sums
+    since the previous flush, e.g. every log_interval batches and at the end of the epoch."""
+
+    def __init__(self, names, device):
+        self.names = tuple(names)
+        self.device = device
+        self.sums = torch.zeros(len(self.names), dtype=torch.float64, device=device)
+        self.totals = dict.fromkeys(self.names, 0.0)
+
+    def add(self, **values):
+        self.sums += torch.stack([torch.as_tensor(values[name], device=self.device).detach().double()
+                                  for name in self.names])
+
+    def flush(self):
+        window = dict(zip(self.names, self.sums.tolist()))
+        self.sums.zero_()
+        for name, value in window.items():
+            self.totals[name] += value
+        return window
+
+
+def train(epoch, model, optimizer, loader_train, lr_list, train_loss_arr, train_kld_loss_arr, train_nll_loss_arr, updating_counter, config, device, walks=None):
+    world_size = get_world_size()
     model.train()
-    train_loss = 0
-    train_kld_loss = 0
-    train_nll_loss = 0
+    metrics = MetricAccumulator(('kld', 'nll'), device)
+    train_samples = 0
+    window_samples = 0
     for batch_idx, (data, _) in enumerate(loader_train):
 
         # transforming data
@@ -35,15 +39,15 @@ def train(epoch, model, optimizer, loader_train, lr_list, train_loss_arr, train_
 
         # forward + backward + optimize
         optimizer.zero_grad()
-        kld_loss, nll_loss, st_observation_list, st_prediction_list, xt_prediction_list, position = model.forward(training_data)
+        trajectory = walks.get() if walks is not None else None
+        kld_loss, nll_loss, st_observation_list, st_prediction_list, xt_prediction_list, position = model.forward(training_data, trajectory)
 
-        loss = nll_loss.item() + kld_loss.item()
-        loss_to_optimize = (nll_loss + kld_loss) / args.batch_size
+        loss_to_optimize = (nll_loss + kld_loss) / len(data)
         #loss_to_optimize = nll_loss + kld_loss
         loss_to_optimize.backward()
 
         # grad norm clipping, only in pytorch version >= 1.10
-        #nn.utils.clip_grad_norm_(GTM_SM_model.parameters(), args.gradient_clip)
+        #nn.utils.clip_grad_norm_(GTM_SM_model.parameters(), config.gradient_clip)
 
         if updating_counter >= 50000:
             for param_group in optimizer.param_groups:
@@ -55,38 +59,54 @@ def train(epoch, model, optimizer, loader_train, lr_list, train_loss_arr, train_
         optimizer.step()
         updating_counter += 1
 
-        # printing
-        if batch_idx % args.log_interval == 0:
-            print('Train Epoch: {} [{}/{} ({:.0f}%)]\t KLD Loss: {:.6f} \t NLL Loss: {:.6f}'.format(
-                epoch, batch_idx * len(data), len(loader_train.dataset),
-                       100. * batch_idx * len(data) / len(loader_train.dataset),
-                       kld_loss.item() / len(data),
-                       nll_loss.item() / len(data)))
-
-        train_loss += loss
-        train_kld_loss += nll_loss.item()
-        train_nll_loss += kld_loss.item()
-
-    train_loss_arr[epoch - 1] = train_loss / len(loader_train.dataset)
-    train_kld_loss_arr[epoch - 1] = train_kld_loss / len(loader_train.dataset)
-    train_nll_loss_arr[epoch - 1] = train_nll_loss / len(loader_train.dataset)
-
-    print('====> Epoch: {} Average loss: {:.4f}'.format(
-        epoch, train_loss / len(loader_train.dataset)))
+        # the losses stay on the device, they are only copied to the host every log_interval batches
+        metrics.add(kld=kld_loss, nll=nll_loss)
+        train_samples += len(data)
+        window_samples += len(data)
+
+        # printing the averages since the previous log line, the progress counts the images of all ranks
+        if batch_idx % config.log_interval == 0:
+            window = metrics.flush()
+            if is_main_process():
+                print('Train Epoch: {} [{}/{} ({:.0f}%)]\t KLD Loss: {:.6f} \t NLL Loss: {:.6f}'.format(
+                    epoch, (train_samples - len(data)) * world_size, len(loader_train.dataset),
+                           100. * (train_samples - len(data)) * world_size / len(loader_train.dataset),
+                           window['kld'] / window_samples,
+                           window['nll'] / window_samples))
+            window_samples = 0
+
+    # averages over the images seen by all ranks
+    metrics.flush()
+    train_kld_loss, train_nll_loss, train_samples = all_reduce_sum(
+        metrics.totals['kld'], metrics.totals['nll'], train_samples)
+    train_loss = train_kld_loss + train_nll_loss
+    train_loss_arr[epoch - 1] = train_loss / train_samples
+    train_kld_loss_arr[epoch - 1] = train_kld_loss / train_samples
+    train_nll_loss_arr[epoch - 1] = train_nll_loss / train_samples
+
+    if is_main_process():
+        print('====> Epoch: {} Average loss: {:.4f}'.format(
+            epoch, train_loss / train_samples))
 
     return updating_counter
 
 
-def test(epoch, model, loader_val, test_nll_loss_arr):
+def test(epoch, model, loader_val, test_nll_loss_arr, config, device, walks=None):
     model.eval()
-    test_loss = 0
+    metrics = MetricAccumulator(('nll',), device)
+    test_samples = 0
     with torch.no_grad():
         for i, (data, _) in enumerate(loader_val):
             data = data.to(device=device)
+            trajectory = walks.get() if walks is not None else None
             kld_loss, nll_loss, st_observation_list, st_prediction_list, xt_prediction_list, position = model.forward(
-                data)
-            test_loss += nll_loss
+                data, trajectory)
+            metrics.add(nll=nll_loss)
+            test_samples += len(data)
 
-    test_loss /= len(loader_val.dataset)
+    metrics.flush()
+    test_loss, test_samples = all_reduce_sum(metrics.totals['nll'], test_samples)
+    test_loss /= test_samples
     test_nll_loss_arr[epoch - 1] = test_loss
-    print('====> Test set loss: {:.4f}'.format(test_loss))
+    if is_main_process():
+        print('====> Test set loss: {:.4f}'.format(test_loss))
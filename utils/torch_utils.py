@@ -5,8 +5,6 @@ from torch.utils.data import sampler
 import argparse
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
 
 def initNetParams(net):
     '''Init net parameters.'''
@@ -47,7 +45,32 @@ class ChunkSampler(sampler.Sampler):
         return self.num_samples
 
 
+def extract_patches(x, position, patch_size=8, stride=3):
+    '''Crop every glimpse visited by a trajectory in one vectorized gather.
+    Arguments:
+        x: images of shape (batch_size, C, H, W)
+        position: grid coordinates (h, w) of shape (batch_size, 2, T), numpy or tensor
+    Returns:
+        crops of shape (T, batch_size, C, patch_size, patch_size)
+    '''
+    if not torch.is_tensor(position):
+        position = torch.from_numpy(np.asarray(position, dtype=np.int64))
+    return gather_patches(x, position.to(device=x.device, dtype=torch.long), patch_size, stride)
+
+
+def gather_patches(x, position, patch_size: int = 8, stride: int = 3):
+    '''TorchScript-compatible core of extract_patches, position must be a long tensor on the device of x'''
+    # strided view over all crop locations, (batch_size, n_h, n_w, C, patch_size, patch_size)
+    windows = x.unfold(2, patch_size, stride).unfold(3, patch_size, stride).permute(0, 2, 3, 1, 4, 5)
+    batch_index = torch.arange(x.size(0), device=x.device).unsqueeze(1)
+    patches = windows[batch_index, position[:, 0], position[:, 1]]
+    return patches.transpose(0, 1)
+
+
 def show_images(images):
+    import matplotlib.pyplot as plt
+    import matplotlib.gridspec as gridspec
+
     if len(images.shape) == 3:
         images = np.expand_dims(images, axis=0)
         print(images.shape)